@@ -27,46 +27,31 @@
 # This will provide two tables: domains and upeople_domains
 
 
-import MySQLdb
-import hashlib, logging, sys
+import cPickle, hashlib, logging, os, sys, threading
+from multiprocessing.pool import ThreadPool
 from optparse import OptionGroup, OptionParser
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
 
-def connect(cfg):
-    user = cfg.db_user
-    password = cfg.db_password
-    host = cfg.db_hostname
-    db = cfg.db_database
+# Name of the temporary table with the digest for each value
+MAP_TABLE = "anonymizer_map"
 
-    try:
-        db = MySQLdb.connect(user = user, passwd = password, db = db)
-        return db
-    except:
-        logging.error("Database connection error")
-    raise
-
-# From GrimoireSQL
-def execute_query (cursor, sql):
-    result = {}
-    cursor.execute(sql)
-    rows = cursor.rowcount
-    columns = cursor.description
-
-    for column in columns:
-        result[column[0]] = []
-    if rows > 1:
-        for value in cursor.fetchall():
-            for (index,column) in enumerate(value):
-                result[columns[index][0]].append(column)
-    elif rows == 1:
-        value = cursor.fetchone()
-        for i in range (0, len(columns)):
-            result[columns[i][0]] = value[i]
-    return result
+
+def connect(cfg, database=None):
+    if database is None: database = cfg.db_database
+    return dbaccess.connect(database, cfg.db_user, cfg.db_password,
+                            cfg.db_hostname, cfg.db_port)
+
+def release(cfg, db, database=None):
+    if database is None: database = cfg.db_database
+    dbaccess.release(db, database, cfg.db_user, cfg.db_password,
+                     cfg.db_hostname, cfg.db_port)
 
 def getOptions():
     parser = OptionParser(usage='Usage: %prog [options]', 
-                          description='Anonymize a field in a table',
+                          description='Anonymize fields in tables',
                           version='0.1')
 
     parser.add_option('-d', '--db-database', dest='db_database',
@@ -83,39 +68,190 @@ def getOptions():
                      default='3306')
     parser.add_option('--db-table', dest='db_table',
                      help='Table with the fields to be anonymized')
-    parser.add_option('--db-field', dest='db_field',
-                     help='Fields to be anonymized')
+    parser.add_option('--db-field', dest='db_field', action='append',
+                     help='Fields to be anonymized, comma separated. ' +
+                          'Use table.field for fields not in --db-table, ' +
+                          'and database.table.field for fields not in ' +
+                          '--db-database. It can be used several times')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int',
+                     help='Values loaded in the mapping table per round-trip',
+                     default=dbaccess.CHUNK_SIZE)
+    parser.add_option('--salt', dest='salt',
+                     help='Secret prepended to values before hashing them, ' +
+                          'the same in all databases', default='')
+    parser.add_option('--cache-file', dest='cache_file',
+                     help='File to keep the digests computed between runs. ' +
+                          'It contains the original values: keep it private',
+                     default=None)
+    parser.add_option('--workers', dest='workers', type='int',
+                     help='Tables anonymized in parallel', default=4)
     (opts, args) = parser.parse_args()
 
     if len(args) != 0:
         parser.error("Arguments should be passed as - or -- options")
 
-    if (not opts.db_table or not opts.db_field):
+    if not opts.db_field:
         parser.error("table and field are needed")
 
+    opts.fields = []
+    for fields in opts.db_field:
+        for field in fields.split(','):
+            field = field.strip().split('.')
+            if len(field) == 3:
+                opts.fields.append(tuple(field))
+            elif len(field) == 2 and opts.db_database:
+                opts.fields.append((opts.db_database, field[0], field[1]))
+            elif len(field) == 1 and opts.db_database and opts.db_table:
+                opts.fields.append((opts.db_database, opts.db_table, field[0]))
+            else:
+                parser.error("database, table and field are needed")
+
     return opts
 
-def anonymize_field (db, table, field):
+def digest (data, salt=''):
+    """Anonymized value for data"""
+
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    elif not isinstance(data, str):
+        data = str(data)
+    return hashlib.md5(salt + data).hexdigest()
+
+class DigestCache(object):
+    """Digests already computed, shared by all tables and databases.
+
+    The same value gets always the same digest, for a given salt. The
+    cache can be saved to a file, and loaded in the next runs so only
+    new values are hashed. A file saved with another salt is ignored.
+    """
+
+    def __init__(self, salt=''):
+        self.salt = salt
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def _salt_id(self):
+        # The salt itself is not stored with the digests
+        return hashlib.sha1("anonymizer" + self.salt).hexdigest()
+
+    def digest(self, data):
+        try:
+            return self.digests[data]
+        except KeyError:
+            anon_data = digest(data, self.salt)
+            self.digests[data] = anon_data
+            return anon_data
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        fd = open(path, 'rb')
+        try:
+            (salt_id, digests) = cPickle.load(fd)
+        finally:
+            fd.close()
+        if salt_id != self._salt_id():
+            logging.info("Digests cache %s uses another salt, ignored", path)
+            return
+        with self.lock:
+            self.digests.update(digests)
+        logging.info("Digests loaded from cache: %i", len(digests))
+
+    def save(self, path):
+        with self.lock:
+            digests = dict(self.digests)
+        tmp = path + ".tmp"
+        fd = open(tmp, 'wb')
+        try:
+            cPickle.dump((self._salt_id(), digests), fd, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+        os.rename(tmp, path)
+        logging.info("Digests saved to cache: %i", len(digests))
+
+def create_map_table (cursor, table, field):
+    """Temporary table mapping values of table.field to their digest.
+
+    The original column is copied with the same type and collation,
+    so the join with table compares values as the table does.
+    """
+
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS %s" % MAP_TABLE)
+    cursor.execute("CREATE TEMPORARY TABLE %s ENGINE=MyISAM " % MAP_TABLE +
+                   "SELECT %s AS orig FROM %s LIMIT 0" % (field, table))
+    cursor.execute("ALTER TABLE %s ADD COLUMN digest CHAR(32) NOT NULL" % MAP_TABLE)
+    column = dbaccess.execute(cursor, "SHOW COLUMNS FROM %s LIKE 'orig'" % MAP_TABLE)
+    if 'text' in column[0][1].lower() or 'blob' in column[0][1].lower():
+        cursor.execute("ALTER TABLE %s ADD INDEX (orig(255))" % MAP_TABLE)
+    else:
+        cursor.execute("ALTER TABLE %s ADD INDEX (orig)" % MAP_TABLE)
+
+def anonymize_field (db, table, field, chunk_size=dbaccess.CHUNK_SIZE,
+                     cache=None):
+    """Replaces all values in table.field with their digest.
+
+    Digests are computed here for the distinct values, loaded in bulk
+    in a temporary mapping table and applied with a single join UPDATE.
+    """
+
+    if cache is None: cache = DigestCache()
     cursor = db.cursor()
     logging.info('Anonymazing %s from %s' % (field, table))
-    q = "SELECT DISTINCT(%s) from %s" % (field, table)
-    anon_list = execute_query(cursor, q)
-    total = len(anon_list[field])
-    done = 0
-    for data in anon_list[field]:
-        if done % 100 == 0: logging.info ("Pending %i ", total-done)
-        anon_data = hashlib.md5(data).hexdigest()
-        q = "UPDATE %s SET %s = '%s' WHERE %s = '%s'" % (table, field, anon_data, field, data)
-        cursor.execute(q)
-        db.commit()
-        done += 1
+    q = "SELECT DISTINCT(%s) from %s WHERE %s IS NOT NULL" % (field, table, field)
+    values = [row[0] for row in dbaccess.execute(cursor, q)]
+    logging.info("Distinct values: %i", len(values))
+
+    create_map_table(cursor, table, field)
+    dbaccess.execute_many(cursor,
+                          "INSERT INTO %s (orig, digest) VALUES (%%s, %%s)" % MAP_TABLE,
+                          ((data, cache.digest(data)) for data in values),
+                          chunk_size)
+    q = "UPDATE %s t, %s m SET t.%s = m.digest WHERE t.%s = m.orig" % \
+        (table, MAP_TABLE, field, field)
+    updated = cursor.execute(q)
+    cursor.execute("DROP TEMPORARY TABLE %s" % MAP_TABLE)
+    db.commit()
+    logging.info("Rows anonymized: %i", updated)
+
+def anonymize_table (args):
+    """Anonymizes fields of a table, with its own connection.
+
+    Used from the worker threads, args is (opts, database, table, fields, cache).
+    """
+
+    (opts, database, table, fields, cache) = args
+    db = connect(opts, database)
+    try:
+        for field in fields:
+            anonymize_field (db, table, field, opts.chunk_size, cache)
+    finally:
+        release(opts, db, database)
 
 def main():
     logging.basicConfig(level=logging.INFO,format='%(asctime)s %(message)s')
 
     opts = getOptions()
-    db = connect(opts)
-    anonymize_field (db, opts.db_table, opts.db_field)
+    cache = DigestCache(opts.salt)
+    if opts.cache_file:
+        cache.load(opts.cache_file)
+
+    # One task per table, with all its fields
+    tables = {}
+    for (database, table, field) in opts.fields:
+        tables.setdefault((database, table), []).append(field)
+    tasks = [(opts, database, table, fields, cache)
+             for ((database, table), fields) in sorted(tables.items())]
+
+    pool = ThreadPool(max(1, min(opts.workers, len(tasks))))
+    try:
+        pool.map(anonymize_table, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if opts.cache_file:
+            cache.save(opts.cache_file)
+    dbaccess.log_query_stats()
+    dbaccess.close_all()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
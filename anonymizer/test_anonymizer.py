@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from anonymizer import DigestCache, digest
+
+
+class DigestTest(unittest.TestCase):
+
+    def test_types(self):
+        self.assertEqual(digest(u'jos\xe9'), digest('jos\xc3\xa9'))
+        self.assertEqual(digest(42), digest('42'))
+
+    def test_salt(self):
+        self.assertNotEqual(digest('john', 'salt'), digest('john'))
+        self.assertEqual(digest('john', 'salt'), digest('john', 'salt'))
+
+
+class DigestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'digests.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_same_digest(self):
+        cache = DigestCache('salt')
+        self.assertEqual(cache.digest('john'), digest('john', 'salt'))
+        self.assertEqual(cache.digest('john'), cache.digest('john'))
+        self.assertEqual(len(cache.digests), 1)
+
+    def test_save_and_load(self):
+        cache = DigestCache('salt')
+        cache.digest('john')
+        cache.digest('jane')
+        cache.save(self.path)
+        self.assertEqual(os.listdir(self.dir), ['digests.cache'])
+
+        loaded = DigestCache('salt')
+        loaded.load(self.path)
+        self.assertEqual(loaded.digests, cache.digests)
+
+    def test_other_salt_ignored(self):
+        cache = DigestCache('salt')
+        cache.digest('john')
+        cache.save(self.path)
+
+        loaded = DigestCache('pepper')
+        loaded.load(self.path)
+        self.assertEqual(loaded.digests, {})
+        self.assertEqual(loaded.digest('john'), digest('john', 'pepper'))
+
+    def test_missing_file(self):
+        cache = DigestCache('salt')
+        cache.load(self.path)
+        self.assertEqual(cache.digests, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+#
+# dbaccess.py
+#
+# Database access shared by the GrimoireUtils scripts:
+#
+#  - connect: connections reused from a pool, per (host, port, user, db)
+#  - connection: connect and release, as a context manager
+#  - execute: parameterized query, rows returned as a list of tuples
+#  - execute_many: executemany in chunks of chunk_size rows
+#  - execute_query: query results as a dict of columns (GrimoireSQL style)
+#  - query_stats: number of calls and time spent per statement
+#
+# Scripts in other directories of GrimoireUtils add this directory to
+# sys.path before importing it:
+#
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+#                                   "..", "common"))
+#   from dbaccess import connection, execute_query
+#
+
+import logging
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+import MySQLdb
+
+# Default number of rows sent to the server by execute_many
+CHUNK_SIZE = 1000
+
+
+class ConnectionPool(object):
+    """Connections to one database, reused among callers.
+
+    get() returns an idle connection, or opens a new one if none is idle.
+    Connections are given back to the pool with put().
+    """
+
+    def __init__(self, max_idle=4, **params):
+        self.params = params
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            while self.idle:
+                db = self.idle.pop()
+                try:
+                    db.ping()
+                    return db
+                except MySQLdb.Error:
+                    logging.info("Discarding broken pooled connection")
+        return MySQLdb.connect(**self.params)
+
+    def put(self, db):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(db)
+                return
+        db.close()
+
+    def close(self):
+        with self.lock:
+            for db in self.idle:
+                db.close()
+            self.idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database, user='root', password='', host='localhost',
+             port=3306, charset=None, **options):
+    """Returns the pool for a database, creating it the first time.
+
+    options are passed to MySQLdb.connect (connect_timeout...)
+    """
+
+    key = (host, int(port), user, database, charset,
+           tuple(sorted(options.items())))
+    with _pools_lock:
+        if key not in _pools:
+            params = dict(host=host, port=int(port), user=user,
+                          passwd=password, db=database)
+            if charset:
+                params['charset'] = charset
+            params.update(options)
+            _pools[key] = ConnectionPool(**params)
+        return _pools[key]
+
+
+def connect(database, user='root', password='', host='localhost',
+            port=3306, charset=None, **options):
+    """Returns a connection to database, reusing a pooled one if possible.
+
+    Give it back with release() when done, instead of closing it.
+    """
+
+    try:
+        return get_pool(database, user, password, host, port, charset,
+                        **options).get()
+    except MySQLdb.Error:
+        logging.error("Database connection error")
+        raise
+
+
+def release(db, database, user='root', password='', host='localhost',
+            port=3306, charset=None, **options):
+    """Gives back to its pool a connection returned by connect()"""
+
+    get_pool(database, user, password, host, port, charset,
+             **options).put(db)
+
+
+@contextmanager
+def connection(database, user='root', password='', host='localhost',
+               port=3306, charset=None, **options):
+    """Context manager for a pooled connection, released on exit.
+
+    with connection(database, user, password) as db:
+        cursor = db.cursor()
+    """
+
+    db = connect(database, user, password, host, port, charset, **options)
+    try:
+        yield db
+    finally:
+        release(db, database, user, password, host, port, charset, **options)
+
+
+def close_all():
+    """Closes all the idle pooled connections"""
+
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+
+# Number of calls and seconds spent, per statement
+_stats = {}
+_stats_lock = threading.Lock()
+
+_literals = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+
+def normalize_query(query):
+    """Returns the statement of a query, with its literal values replaced
+    by '?', so queries built with different values are counted together"""
+
+    statement = _literals.sub('?', query)
+    statement = _lists.sub('(?)', statement)
+    return " ".join(statement.split())
+
+
+def _count(query, started, label=None):
+    elapsed = time.time() - started
+    key = label or normalize_query(query)
+    with _stats_lock:
+        calls, total = _stats.get(key, (0, 0.0))
+        _stats[key] = (calls + 1, total + elapsed)
+
+
+def query_stats():
+    """Returns {statement: (calls, seconds)} for all queries executed.
+
+    Queries are grouped by their label, when given, or their statement.
+    """
+
+    with _stats_lock:
+        return dict(_stats)
+
+
+def log_query_stats(top=10):
+    """Logs the queries with more time spent"""
+
+    stats = sorted(query_stats().items(), key=lambda s: s[1][1], reverse=True)
+    for query, (calls, total) in stats[:top]:
+        logging.info("%8.2fs %6i calls: %s", total, calls, query[:120])
+
+
+def execute(cursor, query, params=None, label=None):
+    """Executes a parameterized query. Returns its rows, as a list.
+
+    label names the query in query_stats, instead of its statement.
+    """
+
+    started = time.time()
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    finally:
+        _count(query, started, label)
+    if rows is None:
+        return []
+    return list(rows)
+
+
+def execute_many(cursor, query, rows, chunk_size=CHUNK_SIZE, label=None):
+    """Executes query for all rows (any iterable), chunk_size at a time.
+
+    Returns the number of rows sent.
+    """
+
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            _execute_chunk(cursor, query, chunk, label)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        _execute_chunk(cursor, query, chunk, label)
+        total += len(chunk)
+    return total
+
+
+def _execute_chunk(cursor, query, chunk, label=None):
+    started = time.time()
+    try:
+        cursor.executemany(query, chunk)
+    finally:
+        _count(query, started, label)
+
+
+def rows_to_columns(columns, rows):
+    """Builds a GrimoireSQL style dict of columns from a list of rows.
+
+    Each column is a list of values, unless there is just one row: then
+    each column is the value itself, as GrimoireSQL does.
+    """
+
+    names = [column[0] for column in columns]
+    if len(rows) == 1:
+        return dict(zip(names, rows[0]))
+    if len(rows) == 0:
+        return dict((name, []) for name in names)
+    # Transpose all rows at once, instead of appending value by value
+    return dict(zip(names, [list(values) for values in zip(*rows)]))
+
+
+# From GrimoireSQL
+def execute_query(cursor, sql, params=None, label=None):
+    """Executes a query and returns its results as a dict of columns"""
+
+    rows = execute(cursor, sql, params, label)
+    columns = cursor.description
+    if columns is None:
+        return {}
+    return rows_to_columns(columns, rows)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import unittest
+
+import dbaccess
+from dbaccess import execute_many, execute_query, normalize_query,\
+    query_stats, rows_to_columns
+
+
+COLUMNS = (('id', None), ('name', None))
+
+
+class FakeCursor(object):
+    """Returns rows for any query, and keeps the chunks sent"""
+
+    def __init__(self, rows, description=COLUMNS):
+        self.rows = rows
+        self.description = description
+        self.chunks = []
+
+    def execute(self, query, params=None):
+        pass
+
+    def executemany(self, query, rows):
+        self.chunks.append(list(rows))
+
+    def fetchall(self):
+        return tuple(self.rows)
+
+
+class RowsToColumnsTest(unittest.TestCase):
+
+    def test_rows(self):
+        columns = rows_to_columns(COLUMNS, [(1, 'a'), (2, 'b'), (3, 'c')])
+        self.assertEqual(columns, {'id' : [1, 2, 3], 'name' : ['a', 'b', 'c']})
+
+    def test_one_row(self):
+        # As GrimoireSQL, a single row gives values instead of lists
+        self.assertEqual(rows_to_columns(COLUMNS, [(1, 'a')]),
+                         {'id' : 1, 'name' : 'a'})
+
+    def test_no_rows(self):
+        self.assertEqual(rows_to_columns(COLUMNS, []),
+                         {'id' : [], 'name' : []})
+
+
+class NormalizeQueryTest(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(normalize_query("SELECT * FROM people WHERE id = 10 AND name = 'john'"),
+                         "SELECT * FROM people WHERE id = ? AND name = ?")
+        self.assertEqual(normalize_query('SELECT * FROM people WHERE email = "a@b.org"'),
+                         "SELECT * FROM people WHERE email = ?")
+
+    def test_escaped_quotes(self):
+        self.assertEqual(normalize_query("SELECT 1 FROM people WHERE name = 'o\\'brien'"),
+                         "SELECT ? FROM people WHERE name = ?")
+
+    def test_lists(self):
+        self.assertEqual(normalize_query("SELECT * FROM t WHERE id IN (1, 2, 3)"),
+                         normalize_query("SELECT * FROM t WHERE id IN (4,5)"))
+
+    def test_whitespace(self):
+        self.assertEqual(normalize_query("SELECT *\n   FROM t\n  WHERE x = 1"),
+                         "SELECT * FROM t WHERE x = ?")
+
+    def test_identifiers_kept(self):
+        self.assertEqual(normalize_query("SELECT * FROM scm2 WHERE c1 = 2"),
+                         "SELECT * FROM scm2 WHERE c1 = ?")
+
+
+class QueryStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        dbaccess._stats.clear()
+
+    def test_grouped_by_statement(self):
+        cursor = FakeCursor([(1, 'a')])
+        execute_query(cursor, "SELECT id, name FROM people WHERE id = 1")
+        execute_query(cursor, "SELECT id, name FROM people WHERE id = 2")
+        stats = query_stats()
+        self.assertEqual(stats.keys(), ["SELECT id, name FROM people WHERE id = ?"])
+        self.assertEqual(stats.values()[0][0], 2)
+
+    def test_grouped_by_label(self):
+        cursor = FakeCursor([])
+        execute_query(cursor, "SELECT id, name FROM people WHERE id = 1", label='people')
+        execute_query(cursor, "SELECT id FROM upeople", label='people')
+        self.assertEqual(query_stats().keys(), ['people'])
+        self.assertEqual(query_stats()['people'][0], 2)
+
+    def test_execute_many_chunks(self):
+        cursor = FakeCursor([])
+        query = "INSERT INTO people (id, name) VALUES (%s, %s)"
+        sent = execute_many(cursor, query, ((i, str(i)) for i in range(5)),
+                            chunk_size=2)
+        self.assertEqual(sent, 5)
+        self.assertEqual([len(chunk) for chunk in cursor.chunks], [2, 2, 1])
+        self.assertEqual(query_stats()[query][0], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
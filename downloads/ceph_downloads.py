@@ -23,12 +23,20 @@
 
 import argparse
 import dateutil.parser
+import gzip
+import hashlib
+import itertools
+import math
+import multiprocessing
 import os
 import re
+import time
 
 from contextlib import contextmanager
+from datetime import date, datetime
 
-from sqlalchemy import create_engine, Column, DateTime, Integer, String
+from sqlalchemy import create_engine, Column, Date, DateTime, Integer, BigInteger, \
+    LargeBinary, String, Table, UniqueConstraint
 from sqlalchemy.engine.url import URL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -41,6 +49,29 @@ package_regexs = [(r'.*\/download.*\/(.*-.*\.t\S+)', 'source'),
                   (r'.*\/(.*_.*_.*\.deb)', 'debian'),
                   (r'.*\/(.*-*-.*\.rpm)', 'rpm')]
 
+# All package regexs in one, tried in the same order. The name of the
+# group that matched is the package type
+PACKAGE_REGEX = re.compile('|'.join(['(?:%s)' % regex.replace('(', '(?P<%s>' % tpkg, 1)
+                                     for regex, tpkg in package_regexs]))
+
+# Downloads inserted and committed at once
+CHUNK_SIZE = 5000
+
+# Length of indexed strings: 255 utf8 characters are 765 bytes, under the
+# 767 bytes limit of InnoDB keys in MySQL 5.5 and 5.6
+KEY_LENGTH = 255
+
+# First bytes of each log stored with its checkpoint, to tell it apart from
+# a file that reuses the inode of a deleted log
+HEAD_LENGTH = 256
+
+# Rollup keys are compared as bytes, as they are in Python. With the default
+# collation, packages differing only in case would break the unique key
+KEY_COLLATION = 'utf8_bin'
+
+MONTHS = {'Jan' : 1, 'Feb' : 2, 'Mar' : 3, 'Apr' : 4, 'May' : 5, 'Jun' : 6,
+          'Jul' : 7, 'Aug' : 8, 'Sep' : 9, 'Oct' : 10, 'Nov' : 11, 'Dec' : 12}
+
 
 # Database
 
@@ -55,10 +86,51 @@ class DownloadEntry(Base):
     ip = Column(String(39))
     package = Column(String(256))
     protocol = Column(String(256))
+    pkg_type = Column(String(32))
+
+    __table_args__ = ({'mysql_charset': 'utf8'})
+
+
+class LogCheckpoint(Base):
+    __tablename__ = 'downloads_checkpoints'
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(String(KEY_LENGTH), unique=True)
+    inode = Column(BigInteger)
+    size = Column(BigInteger)
+    offset = Column(BigInteger)
+    last_date = Column(DateTime)
+    head = Column(LargeBinary(HEAD_LENGTH))
 
     __table_args__ = ({'mysql_charset': 'utf8'})
 
 
+def rollup_table(name, key):
+    """Downloads and unique IPs per date and key (package or package type).
+
+    Daily tables have a row per day, monthly tables one per month, on its
+    first day. ips_sketch is the HyperLogLog sketch of the IPs, so rows can
+    be updated incrementally; unique_ips is its estimation.
+    """
+    return Table(name, Base.metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('date', Date, nullable=False),
+                 Column(key, String(KEY_LENGTH, collation=KEY_COLLATION),
+                        nullable=False),
+                 Column('downloads', BigInteger, nullable=False),
+                 Column('unique_ips', BigInteger, nullable=False),
+                 Column('ips_sketch', LargeBinary(2048), nullable=False),
+                 UniqueConstraint('date', key),
+                 mysql_charset='utf8')
+
+
+# (table, key, period) for each rollup
+ROLLUPS = [(rollup_table('downloads_packages_daily', 'package'), 'package', 'day'),
+           (rollup_table('downloads_packages_monthly', 'package'), 'package', 'month'),
+           (rollup_table('downloads_types_daily', 'pkg_type'), 'pkg_type', 'day'),
+           (rollup_table('downloads_types_monthly', 'pkg_type'), 'pkg_type', 'month')]
+
+
 class Database(object):
 
     def __init__(self, user, password, database, host='localhost', port='3306'):
@@ -71,6 +143,30 @@ class Database(object):
         # Create the schema on the database.
         # It won't replace any existing schema
         Base.metadata.create_all(self._engine)
+        self.upgrade()
+
+    def upgrade(self):
+        """Add the columns, and set the collations, missing in tables
+        created by older versions"""
+        from sqlalchemy import inspect
+
+        inspector = inspect(self._engine)
+        columns = [c['name'] for c in inspector.get_columns('downloads')]
+
+        if 'pkg_type' not in columns:
+            self._engine.execute("ALTER TABLE downloads ADD COLUMN pkg_type VARCHAR(32)")
+
+        columns = [c['name'] for c in inspector.get_columns('downloads_checkpoints')]
+
+        if 'head' not in columns:
+            self._engine.execute("ALTER TABLE downloads_checkpoints ADD COLUMN head BLOB")
+
+        for table, key, period in ROLLUPS:
+            column = [c for c in inspector.get_columns(table.name) if c['name'] == key][0]
+            if getattr(column['type'], 'collation', None) != KEY_COLLATION:
+                self._engine.execute("ALTER TABLE %s MODIFY %s VARCHAR(%d) "
+                                     "CHARACTER SET utf8 COLLATE %s NOT NULL"
+                                     % (table.name, key, KEY_LENGTH, KEY_COLLATION))
 
     @contextmanager
     def connect(self):
@@ -85,6 +181,21 @@ class Database(object):
         finally:
             session.close()
 
+    @contextmanager
+    def transaction(self):
+        """Core connection, for bulk statements, committed on exit"""
+        conn = self._engine.connect()
+        trans = conn.begin()
+
+        try:
+            yield conn
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
     def clear(self):
         session = self._Session()
 
@@ -96,55 +207,519 @@ class Database(object):
 
 # Apache log parser
 
-def parse_downloads_from_log(filepath):
-    downloads = []
+def parse_apache_date(value):
+    """Parse Apache log dates like '10/Oct/2000:13:55:36 -0700'.
 
-    for line in open(filepath, 'rt'):
-        entry = line.rstrip('\r\n')
+    The time zone is ignored, as when storing the dates in the database.
+    """
+    try:
+        return datetime(int(value[7:11]), MONTHS[value[3:6]], int(value[0:2]),
+                        int(value[12:14]), int(value[15:17]), int(value[18:20]))
+    except (KeyError, ValueError):
+        dt = dateutil.parser.parse(value, fuzzy=True)
+        return dt.replace(tzinfo=None)
 
-        m = APACHE_REGEX.match(entry)
 
-        if not m:
-            continue
+def open_log(filepath):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rt')
+
+
+def iter_log_lines(filepath, offset=0):
+    """Generator for the lines of a log, plain or gzipped.
+
+    Reading starts at offset (in uncompressed bytes). Each line comes
+    with the offset just after it. A last line without end of line
+    is still being written, so it is not read.
+    """
+
+    with open_log(filepath) as fd:
+        if offset:
+            fd.seek(offset)
+
+        line = fd.readline()
+        while line.endswith('\n'):
+            offset += len(line)
+            yield line.rstrip('\r\n'), offset
+            line = fd.readline()
+
+
+def parse_download(entry):
+    """Returns (date, ip, package, protocol, package type) for a download
+    log entry, or None if the entry is not a package download"""
+
+    m = APACHE_REGEX.match(entry)
+
+    if not m:
+        return None
+
+    request = m.group(3)
+
+    p = PACKAGE_REGEX.match(request)
+
+    if not p:
+        return None
+
+    ip = m.group(1)
+    dt = parse_apache_date(m.group(2))
+    protocol = 'HTTP'
+    package = p.group(p.lastgroup)
+
+    return (dt, ip, package, protocol, p.lastgroup)
+
+
+# Queue shared by the parser processes, set by init_parser
+_chunks_queue = None
+
+
+def init_parser(queue):
+    global _chunks_queue
+    _chunks_queue = queue
+
+
+def parse_log_chunks(task):
+    """Parse a log from a given offset, for the parser processes.
+
+    task is (index, filepath, offset, since, chunk_size). since, when not
+    None, is the last download inserted, as returned by get_last_downloads:
+    downloads before its date are taken as already inserted and skipped,
+    and so are the ones already inserted with that same date.
+
+    The downloads found are put in the queue of chunks, as they are parsed,
+    in tuples of (index, downloads, end, done) with up to chunk_size
+    downloads; end is the offset up to where the log was read, and done is
+    set for the last chunk of the log. The queue is bounded, so parsers wait while their
+    chunks are not inserted.
+    """
+    index, filepath, end, since, chunk_size = task
+
+    if since:
+        # Dates have one second resolution: downloads in the second of
+        # the last one inserted are matched against the inserted ones
+        last_date, inserted = since[0], dict(since[1])
 
-        ip = m.group(1)
-        dt = dateutil.parser.parse(m.group(2), fuzzy=True)
-        protocol = 'HTTP'
-        request = m.group(3)
+    try:
+        downloads = []
 
-        for regex, tpkg in package_regexs:
-            m = re.match(regex, request)
+        for entry, end in iter_log_lines(filepath, end):
+            download = parse_download(entry)
 
-            if m:
-                package = m.group(1)
-                pkg_type = tpkg
-                downloads.append((dt, ip, package, protocol))
-                break
+            if not download:
+                continue
 
-    return downloads
+            if since and download[0] <= last_date:
+                if download[0] < last_date:
+                    continue
+                key = (download[1], download[2])
+                if inserted.get(key):
+                    inserted[key] -= 1
+                    continue
 
+            downloads.append(download + (end,))
 
-def insert_downloads(db, downloads):
+            if len(downloads) >= chunk_size:
+                _chunks_queue.put((index, downloads, end, False))
+                downloads = []
+
+        _chunks_queue.put((index, downloads, end, True))
+    except Exception, e:
+        # The main process would wait forever for the chunks of this log
+        _chunks_queue.put((index, None, "%s: %s" % (filepath, e), True))
+
+
+def parse_logs(tasks, workers, chunk_size=CHUNK_SIZE):
+    """Generator for the chunks of downloads of several logs, parsed in
+    parallel by worker processes.
+
+    tasks is a list of (filepath, offset, since). Yields (index, downloads, end,
+    done) tuples, as in parse_log_chunks; index is the position of the log
+    in tasks. The chunks of each log come in order.
+    """
+    if not tasks:
+        return
+
+    queue = multiprocessing.Queue(2 * workers)
+    pool = multiprocessing.Pool(workers, init_parser, (queue,))
+    pool.map_async(parse_log_chunks,
+                   [(index, filepath, offset, since, chunk_size)
+                    for index, (filepath, offset, since) in enumerate(tasks)],
+                   chunksize=1)
+    pool.close()
+
+    pending = len(tasks)
+
+    try:
+        while pending:
+            index, downloads, end, done = queue.get()
+
+            if downloads is None:
+                raise RuntimeError("Error parsing %s" % end)
+            if done:
+                pending -= 1
+
+            yield index, downloads, end, done
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def insert_downloads(db, downloads, chunk_size=CHUNK_SIZE, checkpoint=None):
+    """Insert downloads in chunks, with an executemany and a commit per chunk.
+
+    The rollup tables are updated with each chunk, in its transaction.
+
+    checkpoint(conn, download) is called, in the transaction of each chunk,
+    with its last download. Returns the number of downloads inserted.
+    """
+    table = DownloadEntry.__table__
+    downloads = iter(downloads)
+    total = 0
+    start = time.time()
+
+    chunk = list(itertools.islice(downloads, chunk_size))
+    while chunk:
+        rows = [{'date' : d[0], 'ip' : d[1], 'package' : d[2], 'protocol' : d[3],
+                 'pkg_type' : d[4]}
+                for d in chunk]
+
+        with db.transaction() as conn:
+            conn.execute(table.insert(), rows)
+            update_rollups(conn, chunk)
+            if checkpoint:
+                checkpoint(conn, chunk[-1])
+
+        total += len(rows)
+        chunk = list(itertools.islice(downloads, chunk_size))
+
+    elapsed = time.time() - start
+    if total:
+        print "  %d downloads inserted (%.0f rows/s)" % (total, total / max(elapsed, 0.001))
+    return total
+
+
+def get_checkpoints(db):
+    """Returns the checkpoints of the logs already read, by file name"""
+
+    checkpoints = {}
     with db.connect() as session:
-        for d in downloads:
-            entry = DownloadEntry()
-            entry.date = d[0]
-            entry.ip = d[1]
-            entry.package = d[2]
-            entry.protocol = d[3]
+        for cp in session.query(LogCheckpoint):
+            checkpoints[cp.filename] = {'inode' : cp.inode, 'size' : cp.size,
+                                        'offset' : cp.offset,
+                                        'last_date' : cp.last_date,
+                                        'head' : cp.head}
+    return checkpoints
+
+
+def store_checkpoint(conn, filename, inode, size, offset, last_date, head):
+    table = LogCheckpoint.__table__
+    values = {'inode' : inode, 'size' : size, 'offset' : offset, 'head' : head}
+    if last_date:
+        values['last_date'] = last_date
+
+    result = conn.execute(table.update().where(table.c.filename == filename),
+                          values)
+    if result.rowcount == 0:
+        values['filename'] = filename
+        conn.execute(table.insert(), values)
+
+
+def store_checkpoints(conn, checkpoints):
+    """Replace all the checkpoints with checkpoints, a dict by file name
+    as the one returned by find_logs. The ones of deleted logs are removed"""
+    table = LogCheckpoint.__table__
+
+    if checkpoints:
+        conn.execute(table.delete().where(~table.c.filename.in_(checkpoints.keys())))
+    else:
+        conn.execute(table.delete())
+
+    for logfile, cp in checkpoints.items():
+        store_checkpoint(conn, logfile, cp['inode'], cp['size'], cp['offset'],
+                         cp['last_date'], cp['head'])
+
+
+def read_head(filepath):
+    with open_log(filepath) as fd:
+        return fd.read(HEAD_LENGTH)
+
+
+def is_checkpoint_of(cp, filepath, stat, head):
+    """Whether a checkpoint found by name or inode is the one of the log.
 
-            session.add(entry)
+    The inode of a deleted log may be reused by a new file: its first
+    bytes are not the ones stored, or it is shorter than the offset.
+    """
+    if cp['head'] is not None and not head.startswith(cp['head']):
+        return False
+    # Offsets of compressed logs are in uncompressed bytes
+    if not filepath.endswith('.gz') and cp['offset'] > stat.st_size:
+        return False
+    return True
 
 
-def get_last_entry(db):
+def find_checkpoint(logfile, filepath, stat, head, checkpoints, by_inode):
+    """Checkpoint of a log, found by its name or by its inode"""
+
+    cp = checkpoints.get(logfile)
+
+    if cp is None or cp['inode'] != stat.st_ino:
+        # Renamed by the log rotation, or the name belonged to a file
+        # rotated before: its checkpoint is under the name it had
+        cp = by_inode.get(stat.st_ino)
+
+    if cp is not None and not is_checkpoint_of(cp, filepath, stat, head):
+        return None
+
+    return cp
+
+
+def find_copied_checkpoint(filepath, stat, head, checkpoints):
+    """Checkpoint of the log a log was compressed or copied from, by the
+    first bytes stored in it. They must have at least a whole line, so
+    they tell the log apart from the others"""
+
+    found = None
+
+    for cp in checkpoints.values():
+        if not cp['head'] or '\n' not in cp['head']:
+            continue
+        if not is_checkpoint_of(cp, filepath, stat, head):
+            continue
+        if found is None or cp['offset'] > found['offset']:
+            found = cp
+
+    return found
+
+
+def find_start_offset(cp, stat):
+    """Offset where a log with checkpoint cp has to be read from, or None
+    if it is unchanged"""
+
+    if cp is None:
+        # New log, or compressed by the log rotation
+        return 0
+    if cp['size'] == stat.st_size:
+        return None
+    if stat.st_size < cp['size']:
+        # Truncated
+        return 0
+    return cp['offset']
+
+
+def find_logs(logdir, checkpoints, since=None):
+    """Returns (logs, current) for the logs of logdir.
+
+    logs are the ones to be read, each one a tuple of (logfile, filepath,
+    offset, stat, since, head). Logs compressed or copied by the log
+    rotation are read from the offset of the log they were made from.
+    Logs without any checkpoint are read from the beginning, but their
+    downloads up to since, the last ones inserted, are skipped.
+
+    current has the checkpoints of all the logs in logdir, under their
+    current names, to replace the stored ones before reading. Logs to be
+    read have size 0, so they are not taken as unchanged until read.
+    """
+    by_inode = dict([(cp['inode'], cp) for cp in checkpoints.values()])
+
+    logs = []
+    current = {}
+    for logfile in sorted(os.listdir(logdir)):
+        filepath = os.path.join(logdir, logfile)
+        stat = os.stat(filepath)
+        head = read_head(filepath)
+
+        cp = find_checkpoint(logfile, filepath, stat, head, checkpoints, by_inode)
+
+        if cp is not None:
+            offset = find_start_offset(cp, stat)
+        else:
+            cp = find_copied_checkpoint(filepath, stat, head, checkpoints)
+            offset = cp['offset'] if cp else 0
+
+        if offset is None:
+            current[logfile] = dict(cp, head=head)
+            continue
+
+        current[logfile] = {'inode' : stat.st_ino, 'size' : 0, 'offset' : offset,
+                            'last_date' : cp['last_date'] if cp else None,
+                            'head' : head}
+
+        logs.append((logfile, filepath, offset, stat,
+                     since if cp is None else None, head))
+
+    return logs, current
+
+
+def get_last_downloads(db):
+    """Returns (date, inserted) for the last downloads inserted, or None if
+    there are none. inserted has the number of downloads of each
+    (ip, package) inserted with that date"""
     from sqlalchemy.sql.expression import func
 
     with db.connect() as session:
         dt = session.query(func.max(DownloadEntry.date)).one()[0]
 
-    if not dt:
-        dt = dateutil.parser.parse("1900-01-01")
-    return dt
+        if dt is None:
+            return None
+
+        inserted = {}
+        for ip, package in session.query(DownloadEntry.ip, DownloadEntry.package)\
+                                  .filter(DownloadEntry.date == dt):
+            inserted[(ip, package)] = inserted.get((ip, package), 0) + 1
+
+    return dt, inserted
+
+# Rollups
+
+class HyperLogLog(object):
+    """HyperLogLog sketch to estimate the number of distinct values.
+
+    It uses 2^p one byte registers (1024 by default, ~3% of error).
+    Sketches are merged keeping the maximum of each register.
+    """
+
+    def __init__(self, registers=None, p=10):
+        self.p = p
+        self.m = 1 << p
+        if registers:
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = int(hashlib.md5(value).hexdigest()[:16], 16)
+        idx = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        # Position of the leftmost 1 in the remaining 64 - p bits
+        rank = (64 - self.p) - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in
+                                   itertools.izip(self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Linear counting for small cardinalities
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return str(self.registers)
+
+
+def package_type(package):
+    """Type of a package by its extension, for downloads inserted before
+    the type given by the parser was stored"""
+    if package.endswith('.deb'):
+        return 'debian'
+    if package.endswith('.rpm'):
+        return 'rpm'
+    return 'source'
+
+
+def period_date(dt, period):
+    if period == 'month':
+        return date(dt.year, dt.month, 1)
+    return dt.date()
+
+
+def update_rollups(conn, downloads):
+    """Add downloads to the rollup tables, using connection conn.
+
+    Downloads are tuples starting with (date, ip, package, protocol,
+    package type). They are aggregated here, and only the rows of the
+    affected dates and keys are read, merged and written back.
+    """
+    for table, key, period in ROLLUPS:
+        aggregated = {}
+
+        for d in downloads:
+            if key == 'package':
+                # Trailing spaces are ignored by the unique key, even
+                # with a binary collation
+                value = d[2][:KEY_LENGTH].rstrip(' ')
+            else:
+                value = d[4] or package_type(d[2])
+            row_key = (period_date(d[0], period), value)
+
+            if row_key not in aggregated:
+                aggregated[row_key] = [0, HyperLogLog()]
+            aggregated[row_key][0] += 1
+            aggregated[row_key][1].add(d[1])
+
+        if not aggregated:
+            continue
+
+        dates = set([k[0] for k in aggregated])
+        query = table.select().where(table.c.date.in_(dates))
+        current = {}
+        for row in conn.execute(query):
+            current[(row['date'], row[key])] = row
+
+        inserts = []
+        updates = []
+        for (day, value), (count, sketch) in aggregated.items():
+            row = current.get((day, value))
+            if row is not None:
+                sketch.merge(HyperLogLog(row['ips_sketch']))
+                updates.append({'row_id' : row['id'],
+                                'downloads' : row['downloads'] + count,
+                                'unique_ips' : sketch.count(),
+                                'ips_sketch' : sketch.to_bytes()})
+            else:
+                inserts.append({'date' : day, key : value,
+                                'downloads' : count,
+                                'unique_ips' : sketch.count(),
+                                'ips_sketch' : sketch.to_bytes()})
+
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        if updates:
+            from sqlalchemy.sql.expression import bindparam
+
+            stmt = table.update().where(table.c.id == bindparam('row_id'))
+            conn.execute(stmt, updates)
+
+
+def rebuild_rollups(db, chunk_size=CHUNK_SIZE):
+    """Compute again all rollups from the downloads table"""
+
+    downloads = DownloadEntry.__table__
+    total = 0
+
+    # Downloads are streamed with their own connection, as the
+    # other one is used to write while reading
+    reader = db._engine.connect()
+
+    try:
+        with db.transaction() as conn:
+            for table, key, period in ROLLUPS:
+                conn.execute(table.delete())
+
+            result = reader.execution_options(stream_results=True).execute(
+                downloads.select().with_only_columns([downloads.c.date,
+                                                      downloads.c.ip,
+                                                      downloads.c.package,
+                                                      downloads.c.protocol,
+                                                      downloads.c.pkg_type]))
+            rows = result.fetchmany(chunk_size)
+            while rows:
+                update_rollups(conn, [tuple(r) for r in rows if r[0] is not None])
+                total += len(rows)
+                rows = result.fetchmany(chunk_size)
+    finally:
+        reader.close()
+
+    print "Rollups rebuilt from %d downloads" % total
+
 
 # Argument parser
 
@@ -165,6 +740,15 @@ def parse_args():
                        help='Database host port')
     group.add_argument('--clear', action='store_true',
                        help='Delete database contents')
+    group.add_argument('--workers', dest='workers', type=int,
+                       default=multiprocessing.cpu_count(),
+                       help='Number of processes parsing logs')
+    group.add_argument('--chunk-size', dest='chunk_size', type=int,
+                       default=CHUNK_SIZE,
+                       help='Downloads inserted and committed at once')
+    group.add_argument('--rebuild-rollups', dest='rebuild_rollups',
+                       action='store_true',
+                       help='Compute daily and monthly rollups from all downloads')
 
     parser.add_argument('logdir', help='Directory where Apache logs are stored')
 
@@ -180,21 +764,43 @@ if __name__ == '__main__':
     if args.clear:
         db.clear()
 
-    files = os.listdir(args.logdir)
-    files.sort()
+    if args.rebuild_rollups:
+        rebuild_rollups(db, args.chunk_size)
 
-    max_date = get_last_entry(db).date()
+    tasks, checkpoints = find_logs(args.logdir, get_checkpoints(db),
+                                   get_last_downloads(db))
 
-    for logfile in files:
-        file_date = dateutil.parser.parse(logfile, fuzzy=True).date()
+    # Checkpoints are kept under the current names of the logs
+    with db.transaction() as conn:
+        store_checkpoints(conn, checkpoints)
 
-        if file_date < max_date:
-            continue
+    for logfile, filepath, offset, stat, since, head in tasks:
+        print "Analyzing %s from byte %d" % (logfile, offset)
+
+    # Logs are parsed in parallel, and their chunks inserted as they
+    # are ready, in order for each log
+    last_dates = {}
+
+    for index, downloads, end, done in parse_logs([(filepath, offset, since)
+                                                   for _, filepath, offset, _, since, _ in tasks],
+                                                  args.workers, args.chunk_size):
+        logfile, filepath, offset, stat, since, head = tasks[index]
+
+        if downloads:
+            last_dates[index] = downloads[-1][0]
+
+        # While the log is not completely inserted, its size is stored
+        # as 0, so it is never taken as unchanged
+        def checkpoint(conn, download):
+            store_checkpoint(conn, logfile, stat.st_ino, 0, end, download[0], head)
 
-        filepath = os.path.join(args.logdir, logfile)
+        insert_downloads(db, downloads, args.chunk_size, checkpoint)
 
-        print "Analyzing %s" % logfile
+        if done:
+            # Up to the end, including lines without downloads
+            with db.transaction() as conn:
+                store_checkpoint(conn, logfile, stat.st_ino, stat.st_size, end,
+                                 last_dates.get(index), head)
+            print "%s read up to byte %d" % (logfile, end)
 
-        downloads = parse_downloads_from_log(filepath)
-        insert_downloads(db, downloads)
     print "Done"
@@ -27,9 +27,11 @@ import dateutil.parser
 import requests
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from sqlalchemy import Column, Float, DateTime, Integer,\
-    String, create_engine
+    String, and_, create_engine, or_
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -37,6 +39,10 @@ from sqlalchemy.engine.url import URL
 from sqlalchemy.pool import NullPool
 
 
+# Rows sent to the database per executemany
+CHUNK_SIZE = 1000
+
+
 class Database(object):
 
     def __init__(self, user, password, database, host='localhost', port='3306'):
@@ -56,9 +62,22 @@ class Database(object):
         # It won't replace any existing schema
         try:
             Base.metadata.create_all(self._engine)
+            self.upgrade()
         except OperationalError, e:
             raise DatabaseError(error=e.orig[1], code=e.orig[0])
 
+    def upgrade(self):
+        """Add the site_id column to tables created by older versions"""
+        from sqlalchemy import inspect
+
+        inspector = inspect(self._engine)
+
+        for model in RANGE_MODELS + MONTH_MODELS:
+            columns = [c['name'] for c in inspector.get_columns(model.__tablename__)]
+            if 'site_id' not in columns:
+                self._engine.execute("ALTER TABLE %s ADD COLUMN site_id VARCHAR(32)"
+                                     % model.__tablename__)
+
     def connect(self):
         return self._Session()
 
@@ -70,6 +89,28 @@ class Database(object):
             session.rollback()
             raise
 
+    @contextmanager
+    def transaction(self):
+        """Core connection, for bulk statements, committed on exit"""
+        conn = self._engine.connect()
+        trans = conn.begin()
+
+        try:
+            yield conn
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def insert_rows(self, conn, model, rows, chunk_size=CHUNK_SIZE):
+        """Insert dict rows in the table of model, chunk_size at a time"""
+        table = model.__table__
+
+        for i in range(0, len(rows), chunk_size):
+            conn.execute(table.insert(), rows[i:i + chunk_size])
+
     def clear(self):
         session = self._Session()
 
@@ -98,6 +139,7 @@ Base = declarative_base()
 
 class VisitsBase(object):
     id = Column(Integer, primary_key=True)
+    site_id = Column(String(32))
     date = Column(DateTime(timezone=False))
     unique_visitors = Column(Integer)
     visits = Column(Integer)
@@ -123,6 +165,7 @@ class VisitsMonth(VisitsBase, Base):
 
 class CountryBase(object):
     id = Column(Integer, primary_key=True)
+    site_id = Column(String(32))
     date = Column(DateTime(timezone=False))
     country = Column(String(64))
     unique_visitors = Column(Integer)
@@ -146,6 +189,7 @@ class CountryMonth(CountryBase, Base):
 
 class DownloadBase(object):
     id = Column(Integer, primary_key=True)
+    site_id = Column(String(32))
     date = Column(DateTime(timezone=False))
     label = Column(String(256))
     unique_downloads = Column(Integer)
@@ -174,6 +218,7 @@ class DownloadMonth(DownloadBase, Base):
 
 class PageBase(object):
     id = Column(Integer, primary_key=True)
+    site_id = Column(String(32))
     date = Column(DateTime(timezone=False))
     page = Column(String(256))
     visits = Column(Integer)
@@ -208,6 +253,23 @@ class PageMonth(PageBase, Base):
     __table_args__ = ({'mysql_charset': 'utf8'})
 
 
+class SyncState(Base):
+    """Last month fully closed stored on each *_month table, per site.
+
+    table_name is the name of the table and the site, as in sync_state_key.
+    """
+    __tablename__ = 'sync_state'
+    __table_args__ = ({'mysql_charset': 'utf8'})
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(64), unique=True)
+    last_closed_month = Column(DateTime(timezone=False))
+
+
+RANGE_MODELS = [Visits, Country, Download, Page]
+MONTH_MODELS = [VisitsMonth, CountryMonth, DownloadMonth, PageMonth]
+
+
 class Piwik(object):
 
     VISITS = 'VisitsSummary.get'
@@ -218,71 +280,131 @@ class Piwik(object):
     PARAMS = {'module' : 'API',
               'format' : 'JSON'}
 
-    def __init__(self, url, token):
+    # Requests needed to fetch all the data of a site
+    REQUESTS = [(VISITS, 'range'), (VISITS, 'month'),
+                (COUNTRIES, 'range'), (COUNTRIES, 'month'),
+                (DOWNLOADS, 'range'), (DOWNLOADS, 'month'),
+                (PAGES, 'range'), (PAGES, 'month')]
+
+    def __init__(self, url, token, max_workers=8, timeout=300):
         self.url = url
         self.token = token
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        # One keep-alive session, with a connection per worker
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.__reset_dates()
+
+    def fetch(self, site_id, start_date='today', end_date='today',
+              month_start_date=None):
+        return self.fetch_sites([site_id], start_date, end_date,
+                                month_start_date)[site_id]
+
+    def fetch_sites(self, site_ids, start_date='today', end_date='today',
+                    month_start_date=None):
+        """Fetch the data of several sites, running all requests in parallel.
+
+        Range data is fetched from start_date, monthly data from
+        month_start_date, when given, or from start_date.
+        Returns, per site, a dict with the list of rows of each model.
+        """
+        if not month_start_date:
+            month_start_date = start_date
+
+        self.__reset_dates()
+
+        tasks = [(site_id, method, period)
+                 for site_id in site_ids
+                 for method, period in Piwik.REQUESTS]
+
+        def fetch_task(task):
+            site_id, method, period = task
+            if period == 'month':
+                start = month_start_date
+            else:
+                start = start_date
+            return self.__fetch_data(site_id, method, period,
+                                     start, end_date)
 
-    def fetch(self, site_id, start_date='today', end_date='today'):
-        visits = self.fetch_visits(site_id, start_date, end_date)
-        countries = self.fetch_countries(site_id, start_date, end_date)
-        downloads = self.fetch_downloads(site_id, start_date, end_date)
-        pages = self.fetch_pages(site_id, start_date, end_date)
-
-        return visits, countries, downloads, pages
+        pool = ThreadPool(max(1, min(self.max_workers, len(tasks))))
+        try:
+            results = pool.map(fetch_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
-    def fetch_visits(self, site_id, start_date, end_date):
-        # Visits on the given range
-        json = self.__fetch_data(site_id, Piwik.VISITS,
-                                 'range', start_date, end_date)
-        visits = [self.__parse_visits_entry(json, 'range')]
+        data = dict(zip(tasks, results))
 
-        # Visits per month
-        json = self.__fetch_data(site_id, Piwik.VISITS,
-                                 'month', start_date, end_date)
-        visits_month = [v for v in self.__parse_visits(json, 'month')]
+        fetched = {}
+        for site_id in site_ids:
+            site = dict([((method, period), data[(site_id, method, period)])
+                         for method, period in Piwik.REQUESTS])
 
-        visits = visits + visits_month
+            rows = {}
+            rows.update(self.__parse_visits_data(site[(Piwik.VISITS, 'range')],
+                                                 site[(Piwik.VISITS, 'month')]))
+            rows.update(self.__parse_countries_data(site[(Piwik.COUNTRIES, 'range')],
+                                                    site[(Piwik.COUNTRIES, 'month')]))
+            rows.update(self.__parse_downloads_data(site[(Piwik.DOWNLOADS, 'range')],
+                                                    site[(Piwik.DOWNLOADS, 'month')]))
+            rows.update(self.__parse_pages_data(site[(Piwik.PAGES, 'range')],
+                                                site[(Piwik.PAGES, 'month')]))
 
-        return visits
+            fetched[site_id] = rows
 
-    def fetch_countries(self, site_id, start_date, end_date):
-        # Countries data on the given range
-        json = self.__fetch_data(site_id, Piwik.COUNTRIES,
-                                 'range', start_date, end_date)
-        countries = self.__parse_countries(json, 'range')
+        return fetched
 
-        # Countries per month
-        json = self.__fetch_data(site_id, Piwik.COUNTRIES,
-                                 'month', start_date, end_date)
-        countries = countries + self.__parse_countries(json, 'month')
+    def fetch_visits(self, site_id, start_date, end_date):
+        # Visits on the given range and per month
+        self.__reset_dates()
+        return self.__parse_visits_data(
+            self.__fetch_data(site_id, Piwik.VISITS, 'range', start_date, end_date),
+            self.__fetch_data(site_id, Piwik.VISITS, 'month', start_date, end_date))
 
-        return countries
+    def fetch_countries(self, site_id, start_date, end_date):
+        # Countries data on the given range and per month
+        self.__reset_dates()
+        return self.__parse_countries_data(
+            self.__fetch_data(site_id, Piwik.COUNTRIES, 'range', start_date, end_date),
+            self.__fetch_data(site_id, Piwik.COUNTRIES, 'month', start_date, end_date))
 
     def fetch_downloads(self, site_id, start_date, end_date):
-        # Downloads on the given range
-        json = self.__fetch_data(site_id, Piwik.DOWNLOADS,
-                                 'range', start_date, end_date)
-        downloads = self.__parse_downloads(json, 'range')
+        # Downloads on the given range and per month
+        self.__reset_dates()
+        return self.__parse_downloads_data(
+            self.__fetch_data(site_id, Piwik.DOWNLOADS, 'range', start_date, end_date),
+            self.__fetch_data(site_id, Piwik.DOWNLOADS, 'month', start_date, end_date))
 
-        # Donwloads per month
-        json = self.__fetch_data(site_id, Piwik.DOWNLOADS,
-                                 'month', start_date, end_date)
-        downloads = downloads + self.__parse_downloads(json, 'month')
+    def fetch_pages(self, site_id, start_date, end_date):
+        # Pages data on the given range and per month
+        self.__reset_dates()
+        return self.__parse_pages_data(
+            self.__fetch_data(site_id, Piwik.PAGES, 'range', start_date, end_date),
+            self.__fetch_data(site_id, Piwik.PAGES, 'month', start_date, end_date))
 
-        return downloads
+    # Parsed data is returned as plain dict rows, per model (table)
 
-    def fetch_pages(self, site_id, start_date, end_date):
-        # Pages data on the given range
-        json = self.__fetch_data(site_id, Piwik.PAGES,
-                                 'range', start_date, end_date)
-        pages = self.__parse_pages(json, 'range')
+    def __parse_visits_data(self, json_range, json_month):
+        return {Visits : [self.__parse_visits_entry(json_range, 'range')],
+                VisitsMonth : self.__parse_visits(json_month, 'month')}
 
-        # Pages per month
-        json = self.__fetch_data(site_id, Piwik.PAGES,
-                                 'month', start_date, end_date)
-        pages = pages + self.__parse_pages(json, 'month')
+    def __parse_countries_data(self, json_range, json_month):
+        return {Country : self.__parse_countries(json_range, 'range'),
+                CountryMonth : self.__parse_countries(json_month, 'month')}
 
-        return pages
+    def __parse_downloads_data(self, json_range, json_month):
+        return {Download : self.__parse_downloads(json_range, 'range'),
+                DownloadMonth : self.__parse_downloads(json_month, 'month')}
+
+    def __parse_pages_data(self, json_range, json_month):
+        return {Page : self.__parse_pages(json_range, 'range'),
+                PageMonth : self.__parse_pages(json_month, 'month')}
 
     def __fetch_data(self, site_id, method, period, start_date, end_date):
         params = dict(Piwik.PARAMS)
@@ -295,7 +417,7 @@ class Piwik(object):
         if method == Piwik.DOWNLOADS:
             params['expanded'] = 1
 
-        r = requests.get(self.url, params=params)
+        r = self.session.get(self.url, params=params, timeout=self.timeout)
         json = r.json()
 
         return json
@@ -303,7 +425,7 @@ class Piwik(object):
     def __parse_visits(self, json, period):
         entries = []
 
-        for date in json:
+        for date in sorted(json):
             v = json[date]
 
             if not v:
@@ -315,22 +437,19 @@ class Piwik(object):
         return entries
 
     def __parse_visits_entry(self, v, period, date=None):
-        if period == 'month':
-            visits = VisitsMonth()
-        else:
-            visits = Visits()
-
-        visits.date = self.__parse_date(date, period)
-        visits.unique_visitors = v.get('nb_uniq_visitors', None)
-        visits.visits = v['nb_visits']
-        visits.visits_converted = v['nb_visits_converted']
-        visits.avg_time_on_site = float(v['nb_actions_per_visit'])
-        visits.sum_visits_lenght = v['sum_visit_length']
-        visits.actions = v['nb_actions']
-        visits.max_actions = v['max_actions']
-        visits.actions_per_visit = float(v['avg_time_on_site'])
-        visits.bounce = v['bounce_count']
-        visits.bounce_rate = float(v['bounce_rate'].replace('%', ''))
+        visits = {}
+
+        visits['date'] = self.__parse_date(date, period)
+        visits['unique_visitors'] = v.get('nb_uniq_visitors', None)
+        visits['visits'] = v['nb_visits']
+        visits['visits_converted'] = v['nb_visits_converted']
+        visits['avg_time_on_site'] = float(v['nb_actions_per_visit'])
+        visits['sum_visits_lenght'] = v['sum_visit_length']
+        visits['actions'] = v['nb_actions']
+        visits['max_actions'] = v['max_actions']
+        visits['actions_per_visit'] = float(v['avg_time_on_site'])
+        visits['bounce'] = v['bounce_count']
+        visits['bounce_rate'] = float(v['bounce_rate'].replace('%', ''))
 
         return visits
 
@@ -340,7 +459,7 @@ class Piwik(object):
         else:
             entries = []
 
-            for date in json:
+            for date in sorted(json):
                 for c in self.__parse_countries_entries(json[date], period, date):
                     entries.append(c)
         return entries
@@ -351,20 +470,17 @@ class Piwik(object):
         dt = self.__parse_date(date, period)
 
         for c in countries:
-            if period == 'month':
-                country = CountryMonth()
-            else:
-                country = Country()
-
-            country.date = dt
-            country.country = c['label']
-            country.unique_visitors = c.get('nb_uniq_visitors', None)
-            country.visits = c['nb_visits']
-            country.visits_converted = c['nb_visits_converted']
-            country.actions = c['nb_actions']
-            country.max_actions = c['max_actions']
-            country.sum_visits_lenght = c['sum_visit_length']
-            country.bounce = c['bounce_count']
+            country = {}
+
+            country['date'] = dt
+            country['country'] = c['label']
+            country['unique_visitors'] = c.get('nb_uniq_visitors', None)
+            country['visits'] = c['nb_visits']
+            country['visits_converted'] = c['nb_visits_converted']
+            country['actions'] = c['nb_actions']
+            country['max_actions'] = c['max_actions']
+            country['sum_visits_lenght'] = c['sum_visit_length']
+            country['bounce'] = c['bounce_count']
 
             entries.append(country)
 
@@ -376,7 +492,7 @@ class Piwik(object):
         else:
             entries = []
 
-            for date in json:
+            for date in sorted(json):
                 for d in self.__parse_downloads_entries(json[date], period, date):
                     entries.append(d)
         return entries
@@ -390,25 +506,22 @@ class Piwik(object):
             if not 'subtable' in download:
                 continue
             for d in download['subtable']:
-                if period == 'month':
-                    download = DownloadMonth()
-                else:
-                    download = Download()
-
-                download.date = dt
-                download.label = d['label']
-                download.unique_downloads = d['nb_visits']
-                download.downloads = d['nb_hits']
-                download.sum_time_spent = d['sum_time_spent']
-                download.sum_daily_nb_uniq_visitors = d['sum_daily_nb_uniq_visitors']
-                download.url = d.get('url', None)
-                download.entry_nb_visits = d.get('entry_nb_visits', None)
-                download.entry_nb_actions = d.get('entry_nb_actions', None)
-                download.entry_sum_visit_length = d.get('entry_sum_visit_length', None)
-                download.entry_bounce_count = d.get('entry_bounce_count', None)
-                download.exit_nb_visits = d.get('exit_nb_visits', None)
-                download.sum_daily_entry_nb_uniq_visitors = d.get('sum_daily_entry_nb_uniq_visitors', None)
-                download.sum_daily_exit_nb_uniq_visitors = d.get('sum_daily_exit_nb_uniq_visitors', None)
+                download = {}
+
+                download['date'] = dt
+                download['label'] = d['label']
+                download['unique_downloads'] = d['nb_visits']
+                download['downloads'] = d['nb_hits']
+                download['sum_time_spent'] = d['sum_time_spent']
+                download['sum_daily_nb_uniq_visitors'] = d['sum_daily_nb_uniq_visitors']
+                download['url'] = d.get('url', None)
+                download['entry_nb_visits'] = d.get('entry_nb_visits', None)
+                download['entry_nb_actions'] = d.get('entry_nb_actions', None)
+                download['entry_sum_visit_length'] = d.get('entry_sum_visit_length', None)
+                download['entry_bounce_count'] = d.get('entry_bounce_count', None)
+                download['exit_nb_visits'] = d.get('exit_nb_visits', None)
+                download['sum_daily_entry_nb_uniq_visitors'] = d.get('sum_daily_entry_nb_uniq_visitors', None)
+                download['sum_daily_exit_nb_uniq_visitors'] = d.get('sum_daily_exit_nb_uniq_visitors', None)
 
                 entries.append(download)
 
@@ -420,7 +533,7 @@ class Piwik(object):
         else:
             entries = []
 
-            for date in json:
+            for date in sorted(json):
                 for c in self.__parse_pages_entries(json[date], period, date):
                     entries.append(c)
         return entries
@@ -431,45 +544,54 @@ class Piwik(object):
         dt = self.__parse_date(date, period)
 
         for p in pages:
-            if period == 'month':
-                page = PageMonth()
-            else:
-                page = Page()
-
-            page.date = dt
-            page.page = p['label']
-            page.visits = p['nb_visits']
-            page.bounce_rate = float(p['bounce_rate'].replace('%', ''))
-            page.exit_rate = float(p['exit_rate'].replace('%', ''))
-            page.avg_time_on_page = p['avg_time_on_page']
-            page.hits = p['nb_hits']
-            page.sum_time_spent = p['sum_time_spent']
-            page.entry_nb_visits = p.get('entry_nb_visits', None)
-            page.entry_nb_actions = p.get('entry_nb_actions', None)
-            page.entry_sum_visit_length = p.get('entry_sum_visit_length', None)
-            page.entry_bounce = p.get('entry_bounce_count', None)
-            page.exit_nb_visits = p.get('exit_nb_visits', None)
-            page.sum_daily_nb_uniq_visitors = p.get('sum_daily_nb_uniq_visitors', None)
-            page.sum_daily_entry_nb_uniq_visitors = p.get('sum_daily_entry_nb_uniq_visitors', None)
-            page.sum_daily_exit_nb_uniq_visitors = p.get('sum_daily_exit_nb_uniq_visitors', None)
-            page.url = p.get('url', None)
-            page.segment = p.get('segment', None)
-            page.avg_time_generation = p.get('avg_time_generation', None)
-            page.hits_with_time_generation = p.get('hits_with_time_generation', None)
-            page.min_time_generation = p.get('min_time_generation', None)
-            page.max_time_generation = p.get('max_time_generation', None)
-            page.time_spent = p.get('time_spent', None)
+            page = {}
+
+            page['date'] = dt
+            page['page'] = p['label']
+            page['visits'] = p['nb_visits']
+            page['bounce_rate'] = float(p['bounce_rate'].replace('%', ''))
+            page['exit_rate'] = float(p['exit_rate'].replace('%', ''))
+            page['avg_time_on_page'] = p['avg_time_on_page']
+            page['hits'] = p['nb_hits']
+            page['sum_time_spent'] = p['sum_time_spent']
+            page['entry_nb_visits'] = p.get('entry_nb_visits', None)
+            page['entry_nb_actions'] = p.get('entry_nb_actions', None)
+            page['entry_sum_visit_length'] = p.get('entry_sum_visit_length', None)
+            page['entry_bounce'] = p.get('entry_bounce_count', None)
+            page['exit_nb_visits'] = p.get('exit_nb_visits', None)
+            page['sum_daily_nb_uniq_visitors'] = p.get('sum_daily_nb_uniq_visitors', None)
+            page['sum_daily_entry_nb_uniq_visitors'] = p.get('sum_daily_entry_nb_uniq_visitors', None)
+            page['sum_daily_exit_nb_uniq_visitors'] = p.get('sum_daily_exit_nb_uniq_visitors', None)
+            page['url'] = p.get('url', None)
+            page['segment'] = p.get('segment', None)
+            page['avg_time_generation'] = p.get('avg_time_generation', None)
+            page['hits_with_time_generation'] = p.get('hits_with_time_generation', None)
+            page['min_time_generation'] = p.get('min_time_generation', None)
+            page['max_time_generation'] = p.get('max_time_generation', None)
+            page['time_spent'] = p.get('time_spent', None)
 
             entries.append(page)
 
         return entries
 
+    def __reset_dates(self):
+        # Dates are normalized once per fetch: the same few keys are
+        # repeated on every entry, and 'today' must not change meanwhile
+        self.__today = datetime.datetime.now()
+        self.__dates = {}
+
     def __parse_date(self, raw_date, period):
         if not raw_date:
             return None
 
-        dt = dateutil.parser.parse(raw_date)
-        today = datetime.datetime.now()
+        key = (raw_date, period)
+        if key not in self.__dates:
+            self.__dates[key] = self.__normalize_date(raw_date, period)
+        return self.__dates[key]
+
+    def __normalize_date(self, raw_date, period):
+        dt = parse_piwik_date(raw_date)
+        today = self.__today
 
         if self.__is_today(dt, today, period):
             dt = datetime.datetime(dt.year, dt.month, today.day)
@@ -490,8 +612,109 @@ class Piwik(object):
         return is_today
 
 
+def parse_piwik_date(raw_date):
+    """Parse a date key of the Piwik API.
+
+    Keys are 'YYYY-MM' for months and 'YYYY-MM-DD' for days; any other
+    format is left to dateutil.
+    """
+    try:
+        if len(raw_date) == 7 and raw_date[4] == '-':
+            return datetime.datetime(int(raw_date[:4]), int(raw_date[5:7]), 1)
+        if len(raw_date) == 10 and raw_date[4] == '-' and raw_date[7] == '-':
+            return datetime.datetime(int(raw_date[:4]), int(raw_date[5:7]),
+                                     int(raw_date[8:10]))
+    except ValueError:
+        pass
+    return dateutil.parser.parse(raw_date)
+
+
+def sync_state_key(model, site_id):
+    return '%s:%s' % (model.__tablename__, site_id)
+
+
+def get_sync_state(db):
+    """Returns the last closed month stored, per sync_state_key"""
+    session = db.connect()
+    try:
+        states = session.query(SyncState).all()
+        return dict([(state.table_name, state.last_closed_month) for state in states])
+    finally:
+        session.close()
+
+
+def store_sync_state(conn, site_ids, last_closed_month):
+    table = SyncState.__table__
+
+    for model in MONTH_MODELS:
+        for site_id in site_ids:
+            key = sync_state_key(model, site_id)
+            result = conn.execute(table.update().where(table.c.table_name == key),
+                                  last_closed_month=last_closed_month)
+            if result.rowcount == 0:
+                conn.execute(table.insert(), table_name=key,
+                             last_closed_month=last_closed_month)
+
+
+def last_closed_month(end_date):
+    """Last day of the last month fully closed by end_date"""
+    if end_date == 'today':
+        end = datetime.datetime.now()
+    else:
+        end = dateutil.parser.parse(end_date)
+    first_day = datetime.datetime(end.year, end.month, 1)
+    return first_day - datetime.timedelta(days=1)
+
+
+def first_open_day(last_closed):
+    """First day after the last closed month"""
+    dt = last_closed + datetime.timedelta(days=1)
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def site_rows(table, site_id):
+    """Condition for the rows of a site. Rows stored before sites were
+    stored are taken as rows of any site, so they are replaced"""
+    return or_(table.c.site_id == site_id, table.c.site_id == None)
+
+
+def sync(db, rows, month_starts, closed_month, chunk_size=CHUNK_SIZE):
+    """Replace range rows, and monthly rows from month_starts on.
+
+    rows has, per site, the list of dict rows fetched for each model.
+    month_starts has, per (*_month model, site), the first day to replace,
+    or None to replace all its rows. Everything is written in a single
+    transaction.
+    """
+    with db.transaction() as conn:
+        for site_id in rows:
+            for model in RANGE_MODELS:
+                table = model.__table__
+                conn.execute(table.delete().where(site_rows(table, site_id)))
+            for model in MONTH_MODELS:
+                table = model.__table__
+                start = month_starts[(model, site_id)]
+                if start:
+                    conn.execute(table.delete().where(and_(site_rows(table, site_id),
+                                                           table.c.date >= start)))
+                else:
+                    conn.execute(table.delete().where(site_rows(table, site_id)))
+
+            for model in RANGE_MODELS + MONTH_MODELS:
+                model_rows = rows[site_id].get(model, [])
+                start = month_starts.get((model, site_id))
+                if start:
+                    # Months already closed in this table are kept
+                    model_rows = [row for row in model_rows if row['date'] >= start]
+                for row in model_rows:
+                    row['site_id'] = site_id
+                db.insert_rows(conn, model, model_rows, chunk_size)
+
+        store_sync_state(conn, rows.keys(), closed_month)
+
+
 def parse_args():
-    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <url> <site_id>")
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <url> <site_ids>")
 
     # Database options
     group = parser.add_argument_group('Database options')
@@ -516,10 +739,12 @@ def parse_args():
     group.add_argument('--end-date', dest='end_date', default='today')
     group.add_argument('--key', dest='key', required=True,
                        help='Piwik auth key')
+    group.add_argument('--incremental', dest='incremental', action='store_true',
+                       help='Fetch only months not closed yet, keeping the rest')
 
     # Positional arguments
     parser.add_argument('url', help='Piwik server URL')
-    parser.add_argument('site_id', help='Identifier of the site')
+    parser.add_argument('site_ids', help='Identifiers of the sites, separated by commas')
 
     # Parse arguments
     args = parser.parse_args()
@@ -537,20 +762,39 @@ def main():
         raise RuntimeError(str(e))
 
     piwik = Piwik(args.url, args.key)
-    visits, countries, downloads, pages = piwik.fetch(args.site_id,
-                                           args.start_date, args.end_date)
+    site_ids = [site_id.strip() for site_id in args.site_ids.split(',')
+                if site_id.strip()]
+
+    if not args.incremental:
+        rows = piwik.fetch_sites(site_ids, args.start_date, args.end_date)
+
+        # All tables are replaced
+        month_starts = dict([((model, site_id), None)
+                             for model in MONTH_MODELS for site_id in site_ids])
+        sync(db, rows, month_starts, last_closed_month(args.end_date))
+        return
+
+    # Monthly data is fetched from the first month not closed in
+    # all the tables. Tables without state are fetched completely.
+    state = get_sync_state(db)
+    month_starts = {}
+    for model in MONTH_MODELS:
+        for site_id in site_ids:
+            last_closed = state.get(sync_state_key(model, site_id))
+            if last_closed:
+                month_starts[(model, site_id)] = first_open_day(last_closed)
+            else:
+                month_starts[(model, site_id)] = None
 
-    db.clear()
-    session = db.connect()
+    if None in month_starts.values():
+        month_start_date = args.start_date
+    else:
+        month_start_date = min(month_starts.values()).strftime('%Y-%m-%d')
+
+    rows = piwik.fetch_sites(site_ids, args.start_date, args.end_date,
+                             month_start_date)
 
-    for visit in visits:
-        db.store(session, visit)
-    for country in countries:
-        db.store(session, country)
-    for download in downloads:
-        db.store(session, download)
-    for page in pages:
-        db.store(session, page)
+    sync(db, rows, month_starts, last_closed_month(args.end_date))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from ceph_downloads import HyperLogLog, find_logs, package_type,\
+    parse_download, parse_logs
+
+
+LOG_LINE = '10.0.0.%d - - [10/Oct/2014:13:%02d:00 -0700] ' \
+           '"GET /download/ceph-0.%d.tar.gz HTTP/1.1" 200 100 "-" "curl"\n'
+
+
+def entry(request, ip='10.0.0.1'):
+    return '%s - - [10/Oct/2014:13:55:36 -0700] "%s" 200 100 "-" "curl"' \
+        % (ip, request)
+
+
+class TestParseDownload(unittest.TestCase):
+    """Requests are matched by the package regexs, in their order"""
+
+    def test_source(self):
+        d = parse_download(entry('GET /download/ceph-0.87.tar.gz HTTP/1.1'))
+        self.assertEqual(d[1:], ('10.0.0.1', 'ceph-0.87.tar.gz', 'HTTP', 'source'))
+        self.assertEqual(d[0], datetime.datetime(2014, 10, 10, 13, 55, 36))
+
+    def test_debian(self):
+        d = parse_download(entry('GET /debian/pool/main/c/ceph/ceph_0.87-1_amd64.deb HTTP/1.1'))
+        self.assertEqual(d[2:], ('ceph_0.87-1_amd64.deb', 'HTTP', 'debian'))
+
+    def test_rpm(self):
+        d = parse_download(entry('GET /rpm/el7/x86_64/ceph-0.87-0.el7.x86_64.rpm HTTP/1.1'))
+        self.assertEqual(d[2:], ('ceph-0.87-0.el7.x86_64.rpm', 'HTTP', 'rpm'))
+
+    def test_first_regex_wins(self):
+        # A tarball under /download is a source package even if its
+        # name would match the debian regex too
+        d = parse_download(entry('GET /download/ceph_0.87_orig-1.tar.gz HTTP/1.1'))
+        self.assertEqual(d[4], 'source')
+
+    def test_not_a_package(self):
+        self.assertEqual(parse_download(entry('GET /index.html HTTP/1.1')), None)
+        self.assertEqual(parse_download('not an apache log line'), None)
+
+
+class TestHyperLogLog(unittest.TestCase):
+    """Distinct counts are estimated within the expected error"""
+
+    def sketch(self, values):
+        hll = HyperLogLog()
+        for value in values:
+            hll.add(value)
+        return hll
+
+    def assertEstimate(self, estimate, count, error=0.1):
+        self.assertTrue(abs(estimate - count) <= count * error,
+                        "%d estimated for %d" % (estimate, count))
+
+    def test_empty(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_small_counts_exact(self):
+        self.assertEqual(self.sketch(['10.0.0.%d' % i for i in range(10)]).count(), 10)
+
+    def test_repeated_values(self):
+        hll = self.sketch(['10.0.0.%d' % (i % 50) for i in range(5000)])
+        self.assertEstimate(hll.count(), 50)
+
+    def test_large_count(self):
+        hll = self.sketch(['10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255)
+                           for i in range(20000)])
+        self.assertEstimate(hll.count(), 20000)
+
+    def test_merge(self):
+        # Merging sketches counts the union, not the sum
+        a = self.sketch(['ip%d' % i for i in range(0, 3000)])
+        b = self.sketch(['ip%d' % i for i in range(2000, 5000)])
+        a.merge(b)
+        self.assertEstimate(a.count(), 5000)
+        self.assertEqual(a.registers,
+                         self.sketch(['ip%d' % i for i in range(5000)]).registers)
+
+    def test_bytes(self):
+        hll = self.sketch(['ip%d' % i for i in range(100)])
+        copy = HyperLogLog(hll.to_bytes())
+        self.assertEqual(len(hll.to_bytes()), 1024)
+        self.assertEqual(copy.count(), hll.count())
+
+
+class TestPackageType(unittest.TestCase):
+    """Type of downloads inserted before it was stored"""
+
+    def test_package_type(self):
+        self.assertEqual(package_type('ceph_0.87-1_amd64.deb'), 'debian')
+        self.assertEqual(package_type('ceph-0.87-0.el7.x86_64.rpm'), 'rpm')
+        self.assertEqual(package_type('ceph-0.87.tar.gz'), 'source')
+
+
+class TestLogCheckpoints(unittest.TestCase):
+    """Logs rotated and compressed between runs are not read twice"""
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.checkpoints = {}
+        self.inserted = []
+        self.nlines = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.logdir)
+
+    def path(self, logfile):
+        return os.path.join(self.logdir, logfile)
+
+    def write(self, logfile, nlines, minute=None):
+        """Appends nlines, each one in its own minute unless given"""
+        with open(self.path(logfile), 'a') as fd:
+            for _ in range(nlines):
+                self.nlines += 1
+                fd.write(LOG_LINE % (self.nlines,
+                                     self.nlines if minute is None else minute,
+                                     self.nlines))
+
+    def rotate(self):
+        """access.log.1 is compressed into access.log.2.gz, access.log
+        renamed to access.log.1 and a new access.log created"""
+        if os.path.exists(self.path('access.log.1')):
+            with open(self.path('access.log.1'), 'rb') as fd:
+                gz = gzip.open(self.path('access.log.2.gz'), 'wb')
+                gz.write(fd.read())
+                gz.close()
+            os.remove(self.path('access.log.1'))
+        os.rename(self.path('access.log'), self.path('access.log.1'))
+        open(self.path('access.log'), 'w').close()
+
+    def run_once(self):
+        """Does what a run of the script does, with a dict of checkpoints"""
+        since = None
+        if self.inserted:
+            # As get_last_downloads
+            last_date = max([d[0] for d in self.inserted])
+            inserted = {}
+            for d in self.inserted:
+                if d[0] == last_date:
+                    inserted[(d[1], d[2])] = inserted.get((d[1], d[2]), 0) + 1
+            since = (last_date, inserted)
+        tasks, self.checkpoints = find_logs(self.logdir, self.checkpoints, since)
+
+        for index, downloads, end, done in parse_logs([(t[1], t[2], t[4]) for t in tasks],
+                                                      1, 2):
+            logfile, _, _, stat, _, head = tasks[index]
+            self.inserted += downloads
+            if done:
+                self.checkpoints[logfile] = {'inode' : stat.st_ino,
+                                             'size' : stat.st_size,
+                                             'offset' : end,
+                                             'last_date' : None,
+                                             'head' : head}
+
+    def inserted_packages(self):
+        return sorted([d[2] for d in self.inserted])
+
+    def expected_packages(self):
+        return sorted(['ceph-0.%d.tar.gz' % i for i in range(1, self.nlines + 1)])
+
+    def test_rotate_twice_and_compress(self):
+        self.write('access.log', 3)
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+        # Lines written before and after the first rotation
+        self.write('access.log', 2)
+        self.rotate()
+        self.write('access.log', 2)
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+        # Second rotation: access.log.1 is now what access.log was, and
+        # the old access.log.1 is compressed
+        self.write('access.log', 1)
+        self.rotate()
+        self.write('access.log', 2)
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+        # Nothing changed
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+    def test_unchanged_logs_not_read(self):
+        self.write('access.log', 2)
+        self.run_once()
+        tasks, current = find_logs(self.logdir, self.checkpoints)
+        self.assertEqual(tasks, [])
+        self.assertEqual(current, self.checkpoints)
+
+    def test_same_second_after_rotation(self):
+        # Downloads in the second of the last one inserted, in a log
+        # created by the rotation
+        self.write('access.log', 3, minute=30)
+        self.run_once()
+        self.rotate()
+        self.write('access.log', 2, minute=30)
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+    def test_lost_checkpoints(self):
+        # Without checkpoints, the downloads already inserted are skipped,
+        # including the ones in the second of the last one
+        self.write('access.log', 2)
+        self.write('access.log', 3, minute=30)
+        self.run_once()
+        self.checkpoints = {}
+        self.write('access.log', 1, minute=30)
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+
+    def test_reused_inode(self):
+        # Checkpoint of a deleted log whose inode is now the one of
+        # access.log: its offset must not be used
+        self.write('access.log', 4)
+        stat = os.stat(self.path('access.log'))
+        self.checkpoints = {'access.log.3' : {'inode' : stat.st_ino,
+                                              'size' : stat.st_size + 10,
+                                              'offset' : 300,
+                                              'last_date' : None,
+                                              'head' : 'other log'}}
+        self.run_once()
+        self.assertEqual(self.inserted_packages(), self.expected_packages())
+        # Checkpoints of logs no longer in the directory are removed
+        self.assertEqual(self.checkpoints.keys(), ['access.log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import threading
+import unittest
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from piwik import Piwik, Visits, VisitsMonth, Country, CountryMonth,\
+    Download, DownloadMonth, Page, PageMonth
+
+
+MONTHS = ['2014-08', '2014-09', '2014-10']
+
+
+def visits(site_id, month=0):
+    # Number of visits tells the site and the month apart
+    return {'nb_uniq_visitors' : 1,
+            'nb_visits' : int(site_id) * 100 + month,
+            'nb_visits_converted' : 0,
+            'nb_actions_per_visit' : 1,
+            'sum_visit_length' : 10,
+            'nb_actions' : 2,
+            'max_actions' : 2,
+            'avg_time_on_site' : 10,
+            'bounce_count' : 0,
+            'bounce_rate' : '0%'}
+
+
+def countries(site_id):
+    return [{'label' : 'site %s' % site_id,
+             'nb_visits' : 1,
+             'nb_visits_converted' : 0,
+             'nb_actions' : 1,
+             'max_actions' : 1,
+             'sum_visit_length' : 1,
+             'bounce_count' : 0}]
+
+
+def downloads(site_id):
+    return [{'label' : 'download.ceph.com',
+             'subtable' : [{'label' : 'ceph-%s.tar.gz' % site_id,
+                            'nb_visits' : 1,
+                            'nb_hits' : 1,
+                            'sum_time_spent' : 0,
+                            'sum_daily_nb_uniq_visitors' : 1}]}]
+
+
+def pages(site_id):
+    return [{'label' : '/site/%s' % site_id,
+             'nb_visits' : 1,
+             'bounce_rate' : '0%',
+             'exit_rate' : '0%',
+             'avg_time_on_page' : 1,
+             'nb_hits' : 1,
+             'sum_time_spent' : 1}]
+
+
+def response(method, period, site_id):
+    if method == Piwik.VISITS:
+        if period == 'range':
+            return visits(site_id)
+        return dict([(month, visits(site_id, i + 1))
+                     for i, month in enumerate(MONTHS)])
+
+    entries = {Piwik.COUNTRIES : countries,
+               Piwik.DOWNLOADS : downloads,
+               Piwik.PAGES : pages}[method](site_id)
+    if period == 'range':
+        return entries
+    return dict([(month, entries) for month in MONTHS])
+
+
+class PiwikStubHandler(BaseHTTPRequestHandler):
+    """Answers the Piwik API requests with canned data"""
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        body = json.dumps(response(query['method'][0], query['period'][0],
+                                   query['idSite'][0]))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchSites(unittest.TestCase):
+    """Concurrent requests of several sites are returned per site"""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), PiwikStubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.piwik = Piwik(url, 'token', max_workers=4, timeout=10)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rows_per_site(self):
+        data = self.piwik.fetch_sites(['1', '2', '3'], '2014-08-01', '2014-10-31')
+
+        self.assertEqual(sorted(data.keys()), ['1', '2', '3'])
+
+        for site_id in ['1', '2', '3']:
+            rows = data[site_id]
+            self.assertEqual(sorted(rows.keys()),
+                             sorted([Visits, VisitsMonth, Country, CountryMonth,
+                                     Download, DownloadMonth, Page, PageMonth]))
+
+            self.assertEqual([r['visits'] for r in rows[Visits]],
+                             [int(site_id) * 100])
+            self.assertEqual([r['country'] for r in rows[Country]],
+                             ['site %s' % site_id])
+            self.assertEqual([r['label'] for r in rows[DownloadMonth]],
+                             ['ceph-%s.tar.gz' % site_id] * len(MONTHS))
+            self.assertEqual([r['page'] for r in rows[PageMonth]],
+                             ['/site/%s' % site_id] * len(MONTHS))
+
+    def test_months_in_order(self):
+        data = self.piwik.fetch_sites(['1', '2'], '2014-08-01', '2014-10-31')
+
+        for site_id in ['1', '2']:
+            for model in [VisitsMonth, CountryMonth, DownloadMonth, PageMonth]:
+                dates = [r['date'] for r in data[site_id][model]]
+                self.assertEqual(len(dates), len(MONTHS))
+                self.assertEqual(dates, sorted(dates))
+                self.assertEqual([(d.year, d.month) for d in dates],
+                                 [(2014, 8), (2014, 9), (2014, 10)])
+
+            self.assertEqual([r['visits'] for r in data[site_id][VisitsMonth]],
+                             [int(site_id) * 100 + i for i in range(1, len(MONTHS) + 1)])
+
+    def test_fetch_single_site(self):
+        rows = self.piwik.fetch('2', '2014-08-01', '2014-10-31')
+
+        self.assertEqual([r['visits'] for r in rows[Visits]], [200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,16 +25,22 @@
 
 
 from ConfigParser import SafeConfigParser
-import MySQLdb
 
+import cPickle
+import gzip
 import json
 import logging
 from optparse import OptionParser
 import pprint
 import os.path
 import sys
+import time
+import unicodedata
 import urllib2, urllib
-import codecs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
 
 def read_options():
     parser = OptionParser(usage="usage: %prog [options]",
@@ -44,6 +50,13 @@ def read_options():
                       dest="url",
                       default="http://projects.eclipse.org/json/projects/all",
                       help="URL with JSON data for projects")
+    parser.add_option("--max-age",
+                      action="store",
+                      dest="max_age",
+                      type="int",
+                      default=3600,
+                      help="Seconds the cached projects data is used before\
+                            checking if it changed (default 3600)")
     parser.add_option("-t", "--tree",
                       action="store_true",
                       dest="tree",
@@ -95,6 +108,12 @@ def read_options():
                       default=False,
                       help="Generate the databases for projects to repositories\
                             and to children mapping")
+    parser.add_option("--staging",
+                      action="store_true",
+                      dest="staging",
+                      default=False,
+                      help="With --projects, fill staging tables and replace\
+                            the projects tables with them at once")
     parser.add_option("-a", "--automator",
                       action="store",
                       dest="automator_file",
@@ -109,6 +128,10 @@ def read_options():
                       action="store_true",
                       dest="changes",
                       help="Detect changes between automator config and projects data")
+    parser.add_option("--manifest",
+                      action="store",
+                      dest="manifest_file",
+                      help="With --changes, write the changes as JSON to this file")
 
     (opts, args) = parser.parse_args()
     if len(args) != 0:
@@ -318,6 +341,51 @@ def show_fields(project):
         print(key)
 
 
+def get_project_parent(project):
+    """returns the id of the parent of a project, None for roots"""
+    if (len(project['parent_project']) == 0):
+        return None
+    return project['parent_project'][0]['id']
+
+def get_children_index(projects):
+    """returns a dict with the direct children of each project, built
+    in one pass over parent_project"""
+    children = {}
+    for key in projects:
+        parent = get_project_parent(projects[key])
+        if parent is not None:
+            children.setdefault(parent, []).append(key)
+    return children
+
+def get_descendants_index(projects, children = None):
+    """returns a dict with all the descendants of each project.
+
+    Each subtree is walked once: the descendants of a child are reused
+    by all its ancestors."""
+    if children is None:
+        children = get_children_index(projects)
+    descendants = {}
+    visiting = set()
+
+    def walk(project):
+        if project in descendants:
+            return descendants[project]
+        if project in visiting:
+            logging.warn("Cycle in projects hierarchy at " + project)
+            return []
+        visiting.add(project)
+        res = []
+        for child in children.get(project, []):
+            res.append(child)
+            res += walk(child)
+        visiting.discard(project)
+        descendants[project] = res
+        return res
+
+    for key in projects:
+        walk(key)
+    return descendants
+
 def show_projects_hierarchy(projects):
     """Dumps JSON data with hierarchy information"""
     res = {}
@@ -326,10 +394,11 @@ def show_projects_hierarchy(projects):
         data = projects[key]
         #aux["id"]= key
         aux["title"] = data['title']
-        if (len(data['parent_project']) == 0):
+        parent = get_project_parent(data)
+        if parent is None:
             aux["parent_project"] = 'root'
         else:
-            aux["parent_project"] = data['parent_project'][0]['id']
+            aux["parent_project"] = parent
         res[key] = aux
     res['root'] = {"title": "Eclipse Foundation"}
     print json.dumps(res)
@@ -340,6 +409,7 @@ def show_projects_tree(projects, html = False, template_file = None):
 
     tree = ""
     eclipse_projects_url = "https://projects.eclipse.org/projects"
+    children_index = get_children_index(projects)
 
     def compose_n_ws(number):
         output = ""
@@ -351,13 +421,7 @@ def show_projects_tree(projects, html = False, template_file = None):
         return projects[project_name]['title']
 
     def find_children(project):
-        children =[]
-        for key in projects:
-            data = projects[key]
-            if (len(data['parent_project']) != 0):
-                if project == data['parent_project'][0]['id']:
-                    children.append(key)
-        return children
+        return children_index.get(project, [])
 
     def apply_template(tree, template_file):
         fd = open(template_file, 'r')
@@ -516,54 +580,67 @@ def show_duplicates_list(projects):
     pprint.pprint(get_repos_duplicate_list(projects, "scm"))
     pprint.pprint(get_repos_duplicate_list(projects, "mls"))
 
-def create_projects_schema(cursor):
+# Tables filled by create_projects_db_info
+PROJECTS_TABLES = ["projects", "project_repositories", "project_children"]
+STAGING_SUFFIX = "_staging"
+
+def create_projects_schema(cursor, suffix = ""):
     project_table = """
-        CREATE TABLE projects (
+        CREATE TABLE projects%s (
             project_id int(11) NOT NULL AUTO_INCREMENT,
             id varchar(255) NOT NULL,
             title varchar(255) NOT NULL,
             PRIMARY KEY (project_id)
         ) ENGINE=MyISAM DEFAULT CHARSET=utf8
-    """
+    """ % suffix
     project_repositories_table = """
-        CREATE TABLE project_repositories (
+        CREATE TABLE project_repositories%s (
             project_id int(11) NOT NULL,
             data_source varchar(32) NOT NULL,
             repository_name varchar(255) NOT NULL,
             UNIQUE (project_id, data_source, repository_name)
         ) ENGINE=MyISAM DEFAULT CHARSET=utf8
-    """
+    """ % suffix
     project_children_table = """
-        CREATE TABLE project_children (
+        CREATE TABLE project_children%s (
             project_id int(11) NOT NULL,
             subproject_id int(11) NOT NULL,
             UNIQUE (project_id, subproject_id)
         ) ENGINE=MyISAM DEFAULT CHARSET=utf8
-    """
+    """ % suffix
 
     # The data in tables is created automatically.
     # No worries about dropping tables.
-    cursor.execute("DROP TABLE IF EXISTS projects")
-    cursor.execute("DROP TABLE IF EXISTS project_repositories")
-    cursor.execute("DROP TABLE IF EXISTS project_children")
+    for table in PROJECTS_TABLES:
+        cursor.execute("DROP TABLE IF EXISTS " + table + suffix)
 
     cursor.execute(project_table)
     cursor.execute(project_repositories_table)
     cursor.execute(project_children_table)
 
-def get_project_children(project_key, projects):
-    """returns and array with the project names of its children"""
-    children = []
-    for project in projects:
-        data = projects[project]
-        if (len(data['parent_project']) == 0):
-            continue
-        else:
-            parent = data['parent_project'][0]['id']
-            if parent == project_key:
-                children.append(project)
-                children += get_project_children(project, projects)
-    return children
+def swap_projects_tables(cursor, suffix = STAGING_SUFFIX):
+    """Replace the projects tables with the ones named with suffix.
+
+    All of them are renamed in the same RENAME TABLE, which is atomic:
+    readers see either the old tables or the new ones."""
+    for table in PROJECTS_TABLES:
+        # RENAME needs the tables to be replaced
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s LIKE %s%s" % (table, table, suffix))
+        cursor.execute("DROP TABLE IF EXISTS %s_old" % table)
+    renames = ["%s TO %s_old, %s%s TO %s" % (table, table, table, suffix, table)
+               for table in PROJECTS_TABLES]
+    cursor.execute("RENAME TABLE " + ", ".join(renames))
+    for table in PROJECTS_TABLES:
+        cursor.execute("DROP TABLE %s_old" % table)
+
+def get_project_children(project_key, projects, descendants = None):
+    """returns and array with the project names of its children
+
+    descendants is the index from get_descendants_index, to be reused
+    when asking for the children of several projects"""
+    if descendants is None:
+        descendants = get_descendants_index(projects)
+    return list(descendants.get(project_key, []))
 
 def get_project_repos(project, projects, data_source):
     """get all repositories for a project in a data source"""
@@ -598,33 +675,39 @@ def get_automator_repos(data_source, automator_file):
 
     return repos
 
-def set_identities_aff(identities, aff, automator_file):
-    """Search for upeople_id for identities and link it to aff"""
-    linked = False
-    # logging.info("linking %s to %s" % (aff, identities))
-    identities = [identity.replace("'","\\'") for identity in identities]
-    identities = ",".join(["'"+identity+"'" for identity in identities])
-
-    # Search for upeople_id
+def identity_key(identity):
+    """returns the identity as compared by the utf8_general_ci collation
+    of MySQL: ignoring case, accents and trailing spaces"""
+    if isinstance(identity, str):
+        identity = identity.decode('utf-8', 'replace')
+    # Accented letters are decomposed, and their accents removed
+    identity = unicodedata.normalize('NFKD', identity)
+    identity = u"".join([c for c in identity if not unicodedata.combining(c)])
+    return identity.lower().rstrip(u" ")
+
+def get_identities_upeople(automator_file):
+    """returns a dict with the upeople_ids of each identity, read at once"""
     cursor = get_db_cursor_identities(automator_file)
-    q = "SELECT DISTINCT(upeople_id) from identities where identity IN (%s)" % identities
-    res = execute_query(cursor, q)
-    if not isinstance(res['upeople_id'], list): res['upeople_id']=[res['upeople_id']]
-    if len(res['upeople_id']) == 0:
-        # logging.info("Identities not found %s", identities)
-        pass
-    else:
-        for upid in res['upeople_id']:
-            q = """
-                INSERT into upeople_companies (upeople_id, company_id)
-                VALUES ('%s','%s')
-            """ % (upid, aff)
-            res = cursor.execute(q)
-        # logging.info("Server upeople_id found for  %s" % identities)
-        linked = True
-
-
-    return linked
+    cursor.execute("SET NAMES utf8")
+    rows = dbaccess.execute(cursor, "SELECT DISTINCT identity, upeople_id FROM identities")
+    upeople = {}
+    for identity, upeople_id in rows:
+        if identity is None: continue
+        ids = upeople.setdefault(identity_key(identity), [])
+        if upeople_id not in ids:
+            ids.append(upeople_id)
+    return upeople
+
+def set_identities_aff(identities, aff, identities_upeople):
+    """Search for upeople_id for identities and link it to aff.
+
+    Returns the (upeople_id, company_id) rows linking them"""
+    rows = []
+    for identity in identities:
+        for upid in identities_upeople.get(identity_key(identity), []):
+            if (upid, aff) not in rows:
+                rows.append((upid, aff))
+    return rows
 
 
 def create_tables_affiliations(cursor):
@@ -681,27 +764,16 @@ def get_affiliations_db_data(automator_file):
 
 # From GrimoireSQL
 def execute_query (cursor, sql):
-    result = {}
     cursor.execute("SET NAMES utf8")
-    cursor.execute(sql)
-    rows = cursor.rowcount
-    columns = cursor.description
-
-    for column in columns:
-        result[column[0]] = []
-    if rows > 1:
-        for value in cursor.fetchall():
-            for (index,column) in enumerate(value):
-                result[columns[index][0]].append(column)
-    elif rows == 1:
-        value = cursor.fetchone()
-        for i in range (0, len(columns)):
-            result[columns[i][0]] = value[i]
-    return result
+    return dbaccess.execute_query(cursor, sql)
+
+# Global cursor to the identities db, and its connection
+_cursor_identities = None
+_db_identities = None
 
 def get_db_cursor_identities(automator_file):
     """ One global cursor shared in all code """
-    global _cursor_identities
+    global _cursor_identities, _db_identities
 
     if (_cursor_identities is None):
         parser = get_automator_parser(automator_file)
@@ -715,14 +787,24 @@ def get_db_cursor_identities(automator_file):
 
 
         # db = MySQLdb.connect(user = user, passwd = passwd, db = db, charset="utf8", use_unicode=True)
-        if host:
-            db = MySQLdb.connect(user=user, passwd=passwd, db=db, host=host)
-        else:
-            db = MySQLdb.connect(user=user, passwd=passwd, db=db)
+        if not host: host = 'localhost'
+        params = (db, user, passwd, host)
+        db = dbaccess.connect(*params)
+        _db_identities = (db, params)
         _cursor_identities = db.cursor()
 
     return _cursor_identities
 
+def release_db_identities():
+    """Gives back the connection of the global cursor to its pool"""
+    global _cursor_identities, _db_identities
+
+    if _db_identities is not None:
+        db, params = _db_identities
+        dbaccess.release(db, *params)
+        _db_identities = None
+        _cursor_identities = None
+
 
 def create_affiliations(committers, automator_file):
     """Insert into the database the list of affiliations"""
@@ -733,9 +815,8 @@ def create_affiliations(committers, automator_file):
 
     all_affs = get_affiliations(committers)
 
-    for aff in all_affs:
-        q = "INSERT INTO companies (name) VALUES ('%s')" % aff
-        cursor.execute(q)
+    q = "INSERT INTO companies (name) VALUES (%s)"
+    dbaccess.execute_many(cursor, q, [(aff,) for aff in all_affs])
 
     logging.info("Total number of affiliations %i", len(all_affs))
 
@@ -751,10 +832,16 @@ def create_affiliations_identities(affiliations_file, automator_file):
     create_affiliations(committers, automator_file)
 
     affs_id = get_affiliations_db_data(automator_file)
+    if not isinstance(affs_id['name'], list):
+        affs_id = {'name': [affs_id['name']], 'id': [affs_id['id']]}
+    companies = dict(zip(affs_id['name'], affs_id['id']))
+    identities_upeople = get_identities_upeople(automator_file)
 
     npeople = 0
     npeople_aff = 0
     npeople_found = 0
+    upeople_companies = []
+    linked = set()
     for person in committers:
         pdata = committers[person]
         npeople += 1
@@ -781,13 +868,26 @@ def create_affiliations_identities(affiliations_file, automator_file):
         for aff in person_affs:
             person_aff = person_affs[aff]['name']
             # Avoid probs with utf8 enconding. Missing some mappings.
-            if person_aff in affs_id['name']:
-                person_aff_id = affs_id['id'][affs_id['name'].index(person_aff)]
-            if set_identities_aff(person_identifiers, person_aff_id, automator_file):
+            if person_aff not in companies:
+                logging.debug("Affiliation not found " + person_aff)
+                continue
+            rows = set_identities_aff(person_identifiers, companies[person_aff],
+                                      identities_upeople)
+            if len(rows) > 0:
                 npeople_found += 1
+            for row in rows:
+                if row in linked: continue
+                linked.add(row)
+                upeople_companies.append(row)
+
+    cursor = get_db_cursor_identities(automator_file)
+    q = "INSERT INTO upeople_companies (upeople_id, company_id) VALUES (%s, %s)"
+    dbaccess.execute_many(cursor, q, upeople_companies)
+
     logging.info("Total number of people %i", npeople)
     logging.info("Total number of people with affiliations %i", npeople_aff)
     logging.info("Total number of people found in grimoire %i", npeople_found)
+    logging.info("Total number of upeople_companies rows %i", len(upeople_companies))
 
 def get_automator_parser(automator_file):
     # Read db config
@@ -798,8 +898,11 @@ def get_automator_parser(automator_file):
 
     return parser
 
-def create_projects_db_info(projects, automator_file):
-    """Create and fill tables for projects, project_repos and project_children"""
+def create_projects_db_info(projects, automator_file, staging = False):
+    """Create and fill tables for projects, project_repos and project_children
+
+    With staging, the tables are filled with other names and renamed once
+    complete, so readers never find them half filled."""
 
     # Read db config
     parser = get_automator_parser(automator_file)
@@ -814,131 +917,280 @@ def create_projects_db_info(projects, automator_file):
 
 
     # db = MySQLdb.connect(user = user, passwd = passwd, db = db, charset="utf8", use_unicode=True)
-    if host:
-        db = MySQLdb.connect(user=user, passwd=passwd, charset='utf8', db=db, host=host)
-    else:
-        db = MySQLdb.connect(user = user, passwd = passwd, db = db, charset='utf8')
+    if not host: host = 'localhost'
+    with dbaccess.connection(db, user, passwd, host, charset='utf8') as db:
+        fill_projects_db(db, projects, scr_url, staging)
+
+def fill_projects_db(db, projects, scr_url, staging = False):
+    """Fill the projects tables using the connection db"""
+
+    suffix = STAGING_SUFFIX if staging else ""
 
     cursor = db.cursor()
-    create_projects_schema(cursor)
+    create_projects_schema(cursor, suffix)
     logging.info("Projects tables created")
 
-    # First step, load all projects in the table
+    # Project ids are assigned here, in the order AUTO_INCREMENT did,
+    # so all rows can be built before writing any of them
     projects_db = {}
+    projects_rows = []
     for key in projects:
-        title = projects[key]['title']
-        q = "INSERT INTO projects (title, id) values (%s, %s)"
-        cursor.execute(q, (title, key))
-        projects_db[key] = db.insert_id()
-    logging.info("Projects added")
+        projects_db[key] = len(projects_db) + 1
+        projects_rows.append((projects_db[key], key, projects[key]['title']))
 
-    # Insert children for all projects
+    children_rows = []
+    descendants = get_descendants_index(projects)
     for project in projects_db:
-        children = get_project_children(project, projects)
+        children = get_project_children(project, projects, descendants)
         for child in children:
-            q = "INSERT INTO project_children (project_id, subproject_id) values (%s, %s)"
-            project_id = projects_db[project]
-            subproject_id = projects_db[child]
-            cursor.execute(q, (project_id, subproject_id))
-    logging.info("Projects children added")
-
-    def insert_repos(project_id, repos, data_source):
-        for repo in repos:
-            if data_source == "its":
-                repo = repo.replace(" ","%20")
-            q = "INSERT INTO project_repositories VALUES (%s, %s, %s)"
-            cursor.execute(q, (project_id, data_source, repo))
+            children_rows.append((projects_db[project], projects_db[child]))
 
-    # Insert repositories for all projects
+    repos_rows = []
+    repos_seen = set()
     for project in projects_db:
-        repos = get_repos_list_project(project, projects, "scm")
-        insert_repos(projects_db[project], repos, "scm")
-        repos = get_repos_list_project(project, projects, "its")
-        insert_repos(projects_db[project], repos, "its")
-        repos = get_repos_list_project(project, projects, "mls")
-        insert_repos(projects_db[project], repos, "mls")
-        repos = get_repos_list_project(project, projects, "scr", scr_url)
-        insert_repos(projects_db[project], repos, "scr")
-        repos = get_repos_list_project(project, projects, "irc")
-        insert_repos(projects_db[project], repos, "irc")
-
-    logging.info("Projects repositories added")
-
-def show_changes(projects, automator_file):
+        for data_source in ["scm", "its", "mls", "scr", "irc"]:
+            url = scr_url if data_source == "scr" else None
+            repos = get_repos_list_project(project, projects, data_source, url)
+            for repo in repos:
+                if data_source == "its":
+                    repo = repo.replace(" ","%20")
+                # Avoid breaking the UNIQUE key with repeated repositories.
+                # Its collation ignores case and trailing spaces
+                key = (projects_db[project], data_source, repo.lower().rstrip(" "))
+                if key in repos_seen: continue
+                repos_seen.add(key)
+                repos_rows.append((projects_db[project], data_source, repo))
+
+    try:
+        q = "INSERT INTO projects" + suffix + " (project_id, id, title) values (%s, %s, %s)"
+        dbaccess.execute_many(cursor, q, projects_rows)
+        logging.info("Projects added")
+        q = "INSERT INTO project_children" + suffix + " (project_id, subproject_id) values (%s, %s)"
+        dbaccess.execute_many(cursor, q, children_rows)
+        logging.info("Projects children added")
+        q = "INSERT INTO project_repositories" + suffix + " VALUES (%s, %s, %s)"
+        dbaccess.execute_many(cursor, q, repos_rows)
+        logging.info("Projects repositories added")
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    if staging:
+        swap_projects_tables(cursor, suffix)
+        logging.info("Projects tables replaced")
+
+def normalize_repo(repo, data_source):
+    """returns the form of a repository used to compare projects data
+    with automator config"""
+    repo = repo.strip()
+    if data_source == "its":
+        repo = repo.replace("'", "")
+    return repo
+
+def get_projects_repos(projects, data_source):
+    """returns the set of repositories of all projects for a data source,
+    as they are named in automator config"""
+    repos = set()
+    for project in projects:
+        if data_source == "its":
+            repos_prj = get_its_repos(projects[project])
+        elif data_source == "scm":
+            # Just support git repositories
+            if 'source_repo' in projects[project]:
+                if len(projects[project]['source_repo'])>0:
+                    if projects[project]['source_repo'][0]['type'] != "git": continue
+            repos_prj = get_scm_repos(projects[project])
+            repos_prj = [repo.split("/")[-1] for repo in repos_prj]
+            repos_prj = [repo.replace(".git","") for repo in repos_prj]
+        elif data_source == "mls":
+            repos_prj = get_mls_repos(projects[project])
+        else:
+            repos_prj = []
+        for repo in repos_prj:
+            repo = normalize_repo(repo, data_source)
+            if repo <> '': repos.add(repo)
+    return repos
+
+def diff_repos(repos, automator_repos):
+    """returns the (added, removed, unchanged) sets of repositories"""
+    return (repos - automator_repos, automator_repos - repos,
+            repos & automator_repos)
+
+def get_changes(projects, automator_file):
+    """returns, per data source, the repositories added to the projects
+    data, removed from it and unchanged, compared to automator config"""
+    changes = {}
     # scr and irc not yet implemented
     for ds in ["scm","its","mls"]:
-        added = [] # added repositories
-        removed = [] # removed repositories
-        repos = []
         automator_repos = get_automator_repos(ds, automator_file)
-        if ds == "its":
-            automator_repos = [repo.replace("'", "") for repo in automator_repos]
-
-        for project in projects:
-            if ds == "its":
-                repos_prj = get_its_repos(projects[project])
-                for repo in repos_prj: repos.append(repo)
-            elif ds == "scm":
-                # Just support git repositories
-                if 'source_repo' in projects[project]:
-                    if len(projects[project]['source_repo'])>0:
-                        if projects[project]['source_repo'][0]['type'] != "git": continue
-                repos_prj = get_scm_repos(projects[project])
-                repos_prj = [repo.split("/")[-1] for repo in repos_prj]
-                repos_prj = [repo.replace(".git","") for repo in repos_prj]
-                for repo in repos_prj:
-                    if repo<>'': repos.append(repo)
-            elif ds == "mls":
-                repos_prj = get_mls_repos(projects[project])
-                for repo in repos_prj: repos.append(repo)
-        for repo in repos:
-            if repo not in automator_repos:
-                added.append(repo)
-        for repo in automator_repos:
-            if repo not in repos:
-                removed.append(repo)
-        print "Removed repositories for %s %s" % (ds, removed)
-        print "Added repositories for %s %s" % (ds, added)
+        automator_repos = set([normalize_repo(repo, ds) for repo in automator_repos])
+        automator_repos.discard('')
+        repos = get_projects_repos(projects, ds)
+        added, removed, unchanged = diff_repos(repos, automator_repos)
+        changes[ds] = {"added": added, "removed": removed,
+                       "unchanged": unchanged}
+    return changes
+
+def show_changes(projects, automator_file, manifest_file = None):
+    changes = get_changes(projects, automator_file)
+    for ds in ["scm","its","mls"]:
+        print "Removed repositories for %s %s" % (ds, sorted(changes[ds]["removed"]))
+        print "Added repositories for %s %s" % (ds, sorted(changes[ds]["added"]))
+
+    if manifest_file:
+        # Sorted lists, so manifests can be compared between runs
+        manifest = {"automator": os.path.abspath(automator_file),
+                    "changes": {}}
+        for ds in changes:
+            manifest["changes"][ds] = dict([(kind, sorted(changes[ds][kind]))
+                                            for kind in changes[ds]])
+        fd = open(manifest_file, 'w')
+        json.dump(manifest, fd, indent=4, sort_keys=True)
+        fd.close()
+        logging.info("Changes manifest written to " + manifest_file)
+
+# Fields of the projects JSON used by all options but the default one
+COMPACT_FIELDS = {
+    'title': None,
+    'parent_project': ['id'],
+    'source_repo': ['url', 'path', 'type'],
+    'bugzilla': ['query_url'],
+    'mailing_lists': ['url'],
+    'dev_list': ['url']
+}
+
+def compact_projects(projects):
+    """returns the projects with just the COMPACT_FIELDS"""
+    def compact(value, keys):
+        if isinstance(value, list):
+            return [compact(v, keys) for v in value]
+        if keys is None or not isinstance(value, dict): return value
+        return dict([(k, value.get(k)) for k in keys])
+
+    res = {}
+    for key in projects:
+        data = projects[key]
+        res[key] = dict([(field, compact(data[field], keys))
+                         for field, keys in COMPACT_FIELDS.items()
+                         if field in data])
+    return res
+
+def fetch_projects(url, cache_prefix, max_age):
+    """Download url into cache_prefix.json.gz if it changed.
+
+    The server is asked only if the cache was checked more than max_age
+    seconds ago, with the ETag and Last-Modified of the cached copy, so
+    unchanged data is not downloaded again. A compact pickle of the
+    projects is built with every new download."""
+    meta_file = cache_prefix + ".meta"
+    body_file = cache_prefix + ".json.gz"
+
+    meta = {}
+    if os.path.isfile(meta_file) and os.path.isfile(body_file):
+        fd = open(meta_file, 'r')
+        meta = json.load(fd)
+        fd.close()
+        if time.time() - meta.get('checked', 0) < max_age:
+            return
+
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        purl = urllib2.urlopen(request)
+        projects_raw = purl.read().strip('\n')
+        fd = gzip.open(body_file, 'wb')
+        fd.write(projects_raw)
+        fd.close()
+        meta = {'etag': purl.info().getheader('ETag'),
+                'last_modified': purl.info().getheader('Last-Modified')}
+        projects = json.loads(projects_raw)['projects']
+        fd = open(cache_prefix + ".pickle", 'wb')
+        cPickle.dump(compact_projects(projects), fd, cPickle.HIGHEST_PROTOCOL)
+        fd.close()
+        logging.info("Projects data downloaded")
+    except urllib2.HTTPError, e:
+        if e.code != 304:
+            if not meta: raise
+            logging.warning("Can not check projects data, using cached: %s" % e)
+            return
+        logging.info("Projects data not modified")
+    except urllib2.URLError, e:
+        if not meta: raise
+        logging.warning("Can not check projects data, using cached: %s" % e.reason)
+        return
+
+    meta['checked'] = time.time()
+    fd = open(meta_file, 'w')
+    json.dump(meta, fd)
+    fd.close()
+
+def load_projects(url, cache_prefix, max_age, full = False):
+    """returns the projects data, from the cache when possible.
+
+    Unless full is set, just the COMPACT_FIELDS of the projects are
+    loaded, from the pickle, without parsing the JSON."""
+    fetch_projects(url, cache_prefix, max_age)
+
+    pickle_file = cache_prefix + ".pickle"
+    if not full and os.path.isfile(pickle_file):
+        fd = open(pickle_file, 'rb')
+        projects = cPickle.load(fd)
+        fd.close()
+        return projects
+
+    fd = gzip.open(cache_prefix + ".json.gz", 'rb')
+    projects = json.loads(fd.read().decode('utf-8'))['projects']
+    fd.close()
+    if not full:
+        fd = open(pickle_file, 'wb')
+        cPickle.dump(compact_projects(projects), fd, cPickle.HIGHEST_PROTOCOL)
+        fd.close()
+    return projects
 
 if __name__ == '__main__':
     opts = read_options()
     metaproject = opts.url.replace("/","_")
-    json_file = "./"+metaproject+".json"
+    cache_prefix = "./"+metaproject
     # global connection to the db
     _cursor_identities = None
+    _db_identities = None
 
     logging.basicConfig(level=logging.INFO,format='%(asctime)s %(message)s')
     logging.info("Starting Eclipse projects analysis from: " +  opts.url)
 
-    if not os.path.isfile(json_file):
-        purl = urllib2.urlopen(opts.url)
-        projects_raw = purl.read().strip('\n')
-        f = open(json_file,'w')
-        f.write(projects_raw)
-        f.close()
-    projects_raw = codecs.open(json_file, 'r', 'utf-8').read()
-    projects = json.loads(projects_raw)
-    projects = projects['projects']
-
-    if opts.tree:
-        show_projects_tree(projects, opts.tree_html, opts.template_html)
-    elif opts.json_hierarchy:
-        show_projects_hierarchy(projects)
-    elif opts.scm:
-        show_repos_scm_list(projects)
-    elif opts.its:
-        show_repos_its_list(projects)
-    elif opts.mls:
-        show_repos_mls_list(projects)
-    elif opts.scr:
-        show_repos_scr_list(projects)
-    elif opts.dups:
-        show_duplicates_list(projects)
-    elif opts.projects:
-        create_projects_db_info(projects, opts.automator_file)
-    elif opts.affiliations_file is not None:
-        create_affiliations_identities(opts.affiliations_file, opts.automator_file)
-    elif opts.changes:
-        show_changes(projects, opts.automator_file)
-    else:
-        show_projects(projects)
+    # Only the default option (show_projects) needs all the fields
+    full = not (opts.tree or opts.json_hierarchy or opts.scm or opts.its or
+                opts.mls or opts.scr or opts.dups or opts.projects or
+                opts.affiliations_file is not None or opts.changes)
+    projects = load_projects(opts.url, cache_prefix, opts.max_age, full)
+
+    try:
+        if opts.tree:
+            show_projects_tree(projects, opts.tree_html, opts.template_html)
+        elif opts.json_hierarchy:
+            show_projects_hierarchy(projects)
+        elif opts.scm:
+            show_repos_scm_list(projects)
+        elif opts.its:
+            show_repos_its_list(projects)
+        elif opts.mls:
+            show_repos_mls_list(projects)
+        elif opts.scr:
+            show_repos_scr_list(projects)
+        elif opts.dups:
+            show_duplicates_list(projects)
+        elif opts.projects:
+            create_projects_db_info(projects, opts.automator_file, opts.staging)
+        elif opts.affiliations_file is not None:
+            create_affiliations_identities(opts.affiliations_file, opts.automator_file)
+        elif opts.changes:
+            show_changes(projects, opts.automator_file, opts.manifest_file)
+        else:
+            show_projects(projects)
+    finally:
+        release_db_identities()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from eclipse_projects import diff_repos, get_changes, identity_key
+
+
+def project(git_repos, trackers, lists):
+    return {'source_repo' : [{'type' : 'git', 'path' : None,
+                              'url' : 'http://git.eclipse.org/c/%s.git' % repo}
+                             for repo in git_repos],
+            'bugzilla' : [{'query_url' : url} for url in trackers],
+            'mailing_lists' : [{'url' : 'https://dev.eclipse.org/mailman/listinfo/%s' % name}
+                               for name in lists],
+            'dev_list' : [],
+            'parent_project' : []}
+
+
+class DiffReposTest(unittest.TestCase):
+
+    def test_diff(self):
+        added, removed, unchanged = diff_repos(set(['a', 'b', 'c']),
+                                               set(['b', 'c', 'd']))
+        self.assertEqual(added, set(['a']))
+        self.assertEqual(removed, set(['d']))
+        self.assertEqual(unchanged, set(['b', 'c']))
+
+
+class IdentityKeyTest(unittest.TestCase):
+    """Identities compared as in utf8_general_ci"""
+
+    def test_case_and_trailing_spaces(self):
+        self.assertEqual(identity_key('John.Smith@Example.org  '),
+                         identity_key('john.smith@example.org'))
+
+    def test_accents(self):
+        self.assertEqual(identity_key('Jos\xc3\xa9 M\xc3\xbcller'),
+                         identity_key('Jose Muller'))
+        self.assertEqual(identity_key(u'Jos\xe9'), identity_key('JOSE'))
+
+    def test_different(self):
+        self.assertNotEqual(identity_key('Jose'), identity_key('Josa'))
+        self.assertNotEqual(identity_key(' Jose'), identity_key('Jose'))
+
+
+class GetChangesTest(unittest.TestCase):
+    """Projects data compared to an automator config on disk"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        conf_dir = os.path.join(self.dir, 'conf')
+        os.mkdir(conf_dir)
+
+        for repo in ['egit', 'jgit', 'old']:
+            os.makedirs(os.path.join(self.dir, 'scm', repo, '.git'))
+
+        self.automator_file = os.path.join(conf_dir, 'main.conf')
+        fd = open(self.automator_file, 'w')
+        fd.write("[bicho]\n"
+                 "trackers=https://bugs.eclipse.org/bugs/buglist.cgi?product=EGit,\n"
+                 " https://bugs.eclipse.org/bugs/buglist.cgi?product=Old\n")
+        fd.close()
+
+        fd = open(os.path.join(conf_dir, 'mlstats_mailing_lists.conf'), 'w')
+        fd.write("/mnt/mailman_archives/egit-dev.mbox/egit-dev.mbox\n\n")
+        fd.close()
+
+        self.projects = {
+            'technology.egit' : project(['egit/egit', 'jgit/jgit'],
+                                        ["https://bugs.eclipse.org/bugs/buglist.cgi?product='EGit'"],
+                                        ['egit-dev']),
+            'technology.new' : project(['new/new'],
+                                       ['https://bugs.eclipse.org/bugs/buglist.cgi?product=New'],
+                                       ['new-dev', 'egit-dev'])
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scm(self):
+        changes = get_changes(self.projects, self.automator_file)['scm']
+        self.assertEqual(changes['added'], set(['new']))
+        self.assertEqual(changes['removed'], set(['old']))
+        self.assertEqual(changes['unchanged'], set(['egit', 'jgit']))
+
+    def test_its(self):
+        # Quotes in the projects data and spaces in the config are ignored
+        changes = get_changes(self.projects, self.automator_file)['its']
+        self.assertEqual(changes['added'],
+                         set(['https://bugs.eclipse.org/bugs/buglist.cgi?product=New']))
+        self.assertEqual(changes['removed'],
+                         set(['https://bugs.eclipse.org/bugs/buglist.cgi?product=Old']))
+        self.assertEqual(changes['unchanged'],
+                         set(['https://bugs.eclipse.org/bugs/buglist.cgi?product=EGit']))
+
+    def test_mls(self):
+        # Empty lines in the config are not repositories
+        changes = get_changes(self.projects, self.automator_file)['mls']
+        self.assertEqual(changes['added'],
+                         set(['/mnt/mailman_archives/new-dev.mbox/new-dev.mbox']))
+        self.assertEqual(changes['removed'], set())
+        self.assertEqual(changes['unchanged'],
+                         set(['/mnt/mailman_archives/egit-dev.mbox/egit-dev.mbox']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,9 +34,13 @@
 
 import logging
 import MySQLdb, _mysql_exceptions
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+import Queue
 import re
 
+from dbstream import stream_rows, FETCH_BATCH
+
 
 def getOptions():
     parser = OptionParser(usage='Usage: %prog [options]',
@@ -44,10 +48,12 @@ def getOptions():
                                       'for VizGrimoire Data Sources',
                           version='0.1')
     parser.add_option('--data-source', dest='data_source',
-                      help='Data Source to be used (its, mls, irc, mediawiki, releases, qaforums)',
+                      help='Data Source to be used (its, mls, irc, mediawiki, releases, qaforums). ' +
+                           'Several comma separated data sources are read in parallel',
                       default=None)
     parser.add_option('--db-name-ds', dest='db_name_ds',
-                      help='Data source database name', default=None)
+                      help='Data source database name. Comma separated, ' +
+                           'one per data source', default=None)
     parser.add_option('--db-name-ids', dest='db_name_ids',
                       help='Identities database name', default=None)
     parser.add_option('-u', '--db-user', dest='db_user',
@@ -60,6 +66,15 @@ def getOptions():
     parser.add_option('--db-port', dest='db_port',
                       help='Port of the host WHERE database server is running',
                       default='3306')
+    parser.add_option('--in-memory', dest='in_memory', action='store_true',
+                      help='Load identities in memory and write them in bulk ' +
+                           'at the end, instead of querying them per person',
+                      default=False)
+    parser.add_option('--threads', dest='threads', type='int',
+                      help='Data sources read in parallel', default=4)
+    parser.add_option('--fetch-batch', dest='fetch_batch', type='int',
+                      help='Rows read from the databases per round-trip',
+                      default=FETCH_BATCH)
 
     (ops, args) = parser.parse_args()
 
@@ -70,6 +85,9 @@ def getOptions():
            and ops.db_name_ids):
         parser.error("--db-name-ds --db-name-ids --db-user" +
                      "and --data-source are needed")
+    if len(ops.data_source.split(',')) != len(ops.db_name_ds.split(',')):
+        parser.error("--data-source and --db-name-ds need the same " +
+                     "number of values")
     return ops
 
 
@@ -157,24 +175,185 @@ def search_identity(cursor_ids, field, field_type):
     else:
         return []
 
-def main():
-    global reusedids, newids
+def valid_field(field):
+    return field != '' and field is not None and field != 'None'
 
-    supported_data_sources = ["its","its_1","scr","pullpo","mls","irc","mediawiki","releases","qaforums"]
 
-    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(message)s')
+def identity_key(field, field_type):
+    # identities are compared by MySQL with a case insensitive collation,
+    # which also ignores trailing spaces
+    return (field_type, unicode(field).lower().rstrip())
 
-    cfg = getOptions()
-    data_source = cfg.data_source
 
-    if data_source not in supported_data_sources:
-        logging.info ("Data source " + data_source + " not supported.")
-        return
+class IdentitiesDB(object):
+    """Identities read and written with one query per operation"""
 
-    db_database_ds, cursor_ds = connect(cfg.db_name_ds, cfg)
-    db_ids, cursor_ids = connect(cfg.db_name_ids, cfg)
+    def __init__(self, cursor_ids, cursor_ds):
+        self.cursor_ids = cursor_ids
+        self.cursor_ds = cursor_ds
+
+    def search(self, field, field_type):
+        results = search_identity(self.cursor_ids, field, field_type)
+        if len(results) > 0:
+            return int(results[0][0])
+        return None
+
+    def insert_identity(self, upeople_id, field, field_type):
+        insert_identity(self.cursor_ids, upeople_id, field, field_type)
+
+    def insert_upeople(self, people_id, field, field_type):
+        return insert_upeople(self.cursor_ids, self.cursor_ds, people_id,
+                              field, field_type)
+
+    def insert_people_upeople(self, people_id, upeople_id):
+        insert_people_upeople(self.cursor_ds, people_id, upeople_id)
+
+    def flush(self):
+        pass
+
+
+class IdentitiesIndex(object):
+    """Identities loaded in memory, with writes buffered until flush.
+
+    identities are indexed by (type, identity), and new upeople ids
+    are given from a counter initialized with MAX(id) in upeople.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, db_ids, cursor_ds, fetch_batch=FETCH_BATCH):
+        self.cursor_ids = db_ids.cursor()
+        self.index = {}
+        self.new_upeople = []
+        self.new_identities = []
+        # people_upeople rows pending, per data source cursor
+        self.new_people_upeople = {}
+        self.set_data_source(cursor_ds)
+
+        query = "SELECT upeople_id, identity, type FROM identities"
+        for (upeople_id, identity, field_type) in stream_rows(db_ids, query,
+                                                              fetch_batch=fetch_batch):
+            if identity is None: continue
+            key = identity_key(identity, field_type)
+            # Keep the first one, as SELECT without ORDER in search_identity
+            if key not in self.index:
+                self.index[key] = int(upeople_id)
+
+        results = execute_query(self.cursor_ids, "SELECT MAX(id) FROM upeople;")
+        last_id = results[0][0]
+        if last_id is None: last_id = 0
+        self.last_id = int(last_id)
+
+    def set_data_source(self, cursor_ds):
+        """Data source where people_upeople rows are written from now on"""
+        self.cursor_ds = cursor_ds
+        self.new_people_upeople.setdefault(cursor_ds, [])
+
+    def search(self, field, field_type):
+        return self.index.get(identity_key(field, field_type))
+
+    def insert_identity(self, upeople_id, field, field_type):
+        if not valid_field(field):
+            return
+        key = identity_key(field, field_type)
+        if key in self.index:
+            return
+        self.index[key] = upeople_id
+        self.new_identities.append((upeople_id, field, field_type))
+
+    def insert_upeople(self, people_id, field, field_type):
+        if not valid_field(field):
+            return None
+        self.last_id += 1
+        upeople_id = self.last_id
+        self.new_upeople.append((upeople_id, field))
+        self.insert_identity(upeople_id, field, field_type)
+        self.insert_people_upeople(people_id, upeople_id)
+        return upeople_id
+
+    def insert_people_upeople(self, people_id, upeople_id):
+        self.new_people_upeople[self.cursor_ds].append((people_id, upeople_id))
+
+    def _insert_many(self, cursor, query, rows):
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            cursor.executemany(query, rows[i:i + self.BATCH_SIZE])
+
+    def flush(self):
+        logging.info(" Writing %i upeople, %i identities" %
+                     (len(self.new_upeople), len(self.new_identities)))
+        self._insert_many(self.cursor_ids,
+                          "INSERT INTO upeople (id, identifier) VALUES (%s, %s)",
+                          self.new_upeople)
+        self._insert_many(self.cursor_ids,
+                          "INSERT INTO identities (upeople_id, identity, type) " +
+                          "VALUES (%s, %s, %s)",
+                          self.new_identities)
+        # Already existing people_id are ignored, as in insert_people_upeople
+        for cursor_ds, rows in self.new_people_upeople.items():
+            self._insert_many(cursor_ds,
+                              "INSERT IGNORE INTO people_upeople (people_id, upeople_id) " +
+                              "VALUES (%s, %s)",
+                              rows)
+            self.new_people_upeople[cursor_ds] = []
+        self.new_upeople = []
+        self.new_identities = []
+
+
+def unify_person(identities, people_id, name, email, user_id):
+    """Find or create the upeople for a person, and register its identities.
+
+    Returns the upeople_id and True if it is a new one, or None if
+    the person has no valid identifier.
+    """
+    upeople_id = None
+
+    # Try to find the upeople using all identifiers
+    # If upeople is not found create the new identity
+    # We use the email field available in all data sources as the main identifier
+    for field_type in  ['name','email','user_id']:
+        if field_type == 'email': field = email
+        elif field_type == 'name':
+            field = name
+            if field is None: continue
+            # For name, at least first and family
+            # \s: any whitespace character \w: any alphanumeric character and the underscore
+            if not re.match(r"\w+\s\w+", field): continue
+        elif field_type == 'user_id': field = user_id
+        if valid_field(field):
+            found = identities.search(field, field_type)
+            if found is not None:
+                upeople_id = found
+
+    new = False
+    if upeople_id is None:
+        upeople_id = identities.insert_upeople(people_id, email, "email")
+        if upeople_id is None:
+            if name is not None:
+                if re.match(r"\w+\s\w+", name):
+                    upeople_id = identities.insert_upeople(people_id, name, "name")
+        if upeople_id is None:
+            upeople_id = identities.insert_upeople(people_id, user_id, "user_id")
+        if upeople_id is None:
+            logging.error("Can't register %s %s %s" % (email, name, user_id))
+            return None
+        new = True
+    else:
+        # The empty people_upeople table should be populated
+        identities.insert_people_upeople(people_id, upeople_id)
+
+    # We have now the upeople_id, but we don't now with which field.
+    # Try to insert all fields and in insert_identity if already do nothing
+    identities.insert_identity(upeople_id, email, "email")
+    identities.insert_identity(upeople_id, user_id, "user_id")
+    # Just insert identifiers with a correct format for name
+    if name is not None:
+        if re.match(r"\w+\s\w+", name):
+            identities.insert_identity(upeople_id, name, "name")
+
+    return upeople_id, new
 
-    create_tables(db_database_ds, cursor_ds)
+
+def get_query(data_source):
     if (data_source == "its" or data_source == "its_1" or data_source == "scr"):
         query = "SELECT id, name, email, user_id FROM people"
     elif (data_source == "mls"):
@@ -190,92 +369,145 @@ def main():
     elif (data_source == "pullpo"):
         query = "SELECT id, login, email FROM people"
     else:
-        return
-    results = execute_query(cursor_ds, query)
-    total = len(results)
-    logging.info ("Generating unique identities for " + data_source)
-    logging.info (" Total identities to analyze: " + str(total))
+        query = None
+    return query
+
 
+def get_person(data_source, result):
+    """ Returns people_id, name, email and user_id from a data source row """
     # people_id used for main identifier for upeople
-    for result in results:
-        if data_source in ['irc','mediawiki']:
-            name = result[0]
-            people_id = user_id = name
-            email = None
-        elif data_source in ['releases', 'qaforums']:
-            people_id = int(result[0])
-            name = result[1]
-            email = result[2]
-            user_id = result[1]
-        elif (data_source == "mls"):
-            name = result[0]
-            email = result[1]
-            people_id = email
-            user_id = None
-        elif (data_source == "pullpo"):
-            people_id = result[0]
-            name = user_id = result[1]
-            email = result[2]
-        elif (data_source == "its" or data_source == "its_1" or data_source == "scr"):
-            people_id = int(result[0])
-            name = result[1]
-            email = result[2]
-            user_id = result[3]
-        else:
-            people_id = int(result[0])
-            user_id = name = result[1]
-            email = None
-
-        upeople_id = None
-
-        # Try to find the upeople using all identifiers
-        # If upeople is not found create the new identity
-        # We use the email field available in all data sources as the main identifier
-        for field_type in  ['name','email','user_id']:
-            if field_type == 'email': field = email
-            elif field_type == 'name':
-                field = name
-                if field is None: continue
-                # For name, at least first and family
-                # \s: any whitespace character \w: any alphanumeric character and the underscore
-                if not re.match(r"\w+\s\w+", field): continue
-            elif field_type == 'user_id': field = user_id
-            if field != '' and field is not None and field != 'None':
-                results_ids = search_identity(cursor_ids, field, field_type)
-                if len(results_ids) > 0:
-                    upeople_id = int(results_ids[0][0])
+    if data_source in ['irc','mediawiki']:
+        name = result[0]
+        people_id = user_id = name
+        email = None
+    elif data_source in ['releases', 'qaforums']:
+        people_id = int(result[0])
+        name = result[1]
+        email = result[2]
+        user_id = result[1]
+    elif (data_source == "mls"):
+        name = result[0]
+        email = result[1]
+        people_id = email
+        user_id = None
+    elif (data_source == "pullpo"):
+        people_id = result[0]
+        name = user_id = result[1]
+        email = result[2]
+    elif (data_source == "its" or data_source == "its_1" or data_source == "scr"):
+        people_id = int(result[0])
+        name = result[1]
+        email = result[2]
+        user_id = result[3]
+    else:
+        people_id = int(result[0])
+        user_id = name = result[1]
+        email = None
+    return people_id, name, email, user_id
 
-        if upeople_id is None:
-            upeople_id = insert_upeople(cursor_ids, cursor_ds, people_id,
-                                        email, "email")
-            if upeople_id is None:
-                if name is not None:
-                    if re.match(r"\w+\s\w+", name):
-                        upeople_id = insert_upeople(cursor_ids, cursor_ds, people_id,
-                                                name, "name")
-            if upeople_id is None:
-                upeople_id = insert_upeople(cursor_ids, cursor_ds, people_id,
-                                            user_id, "user_id")
-            if upeople_id is None:
-                logging.error("Can't register %s %s %s" % (email, name, user_id))
-                continue
-            newids += 1
-        else:
-            # The empty people_upeople table should be populated
-            insert_people_upeople(cursor_ds, people_id, upeople_id)
-            reusedids += 1
-
-        # We have now the upeople_id, but we don't now with which field.
-        # Try to insert all fields and in insert_identity if already do nothing
-        insert_identity(cursor_ids, upeople_id, email, "email")
-        insert_identity(cursor_ids, upeople_id, user_id, "user_id")
-        # Just insert identifiers with a correct format for name
-        if name is not None:
-            if re.match(r"\w+\s\w+", name):
-                insert_identity(cursor_ids, upeople_id, name, "name")
 
+def read_data_source(args):
+    """ Read all rows of a data source, using its own connection.
+
+    Used from the reader threads, args is (cfg, data_source, db_name, queue).
+    All rows are put in queue at once, followed by None. If reading fails,
+    the exception is put in queue instead.
+
+    Rows are read with a buffered cursor, not streamed: a data source may
+    wait for the ones before it to be unified, and a stream left unread
+    that long is cut by the server (net_write_timeout).
+    """
+    cfg, data_source, db_name, queue = args
+    try:
+        db, cursor = connect(db_name, cfg)
+        try:
+            cursor.execute(get_query(data_source))
+            rows = cursor.fetchall()
+        finally:
+            db.close()
+    except Exception, e:
+        queue.put(e)
+        return
+    queue.put(rows)
+    queue.put(None)
+
+
+def read_queue(queue):
+    """ Generator for the rows put in queue by read_data_source """
+    rows = queue.get()
+    while rows is not None:
+        if isinstance(rows, Exception):
+            raise rows
+        for row in rows:
+            yield row
+        rows = queue.get()
+
+
+def main():
+    global reusedids, newids
+
+    supported_data_sources = ["its","its_1","scr","pullpo","mls","irc","mediawiki","releases","qaforums"]
+
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(message)s')
+
+    cfg = getOptions()
+    data_sources = []
+    for data_source, db_name in zip(cfg.data_source.split(','),
+                                    cfg.db_name_ds.split(',')):
+        if data_source not in supported_data_sources:
+            logging.info ("Data source " + data_source + " not supported.")
+            continue
+        data_sources.append((data_source, db_name))
+    if len(data_sources) == 0:
+        return
+
+    db_ids, cursor_ids = connect(cfg.db_name_ids, cfg)
+
+    # Connections used to write people_upeople in each data source
+    dbs_ds = {}
+    for data_source, db_name in data_sources:
+        dbs_ds[(data_source, db_name)] = connect(db_name, cfg)
+        create_tables(*dbs_ds[(data_source, db_name)])
+
+    # With several data sources, a single in memory index gives all
+    # upeople ids, so they are consistent among data sources
+    if cfg.in_memory or len(data_sources) > 1:
+        identities = IdentitiesIndex(db_ids, None, cfg.fetch_batch)
+    else:
+        identities = IdentitiesDB(cursor_ids, dbs_ds[data_sources[0]][1])
+
+    # Rows are read in parallel, and unified in the order of the data
+    # sources as they arrive. Readers are started in that order, so the
+    # data source being unified has always its reader running.
+    queues = [Queue.Queue() for ds in data_sources]
+    pool = ThreadPool(max(1, min(cfg.threads, len(data_sources))))
+    pool.map_async(read_data_source,
+                   [(cfg, ds, db_name, queue) for (ds, db_name), queue
+                    in zip(data_sources, queues)], chunksize=1)
+
+    total = 0
+    for (data_source, db_name), queue in zip(data_sources, queues):
+        if isinstance(identities, IdentitiesIndex):
+            identities.set_data_source(dbs_ds[(data_source, db_name)][1])
+        logging.info ("Generating unique identities for " + data_source)
+
+        for result in read_queue(queue):
+            total += 1
+            people_id, name, email, user_id = get_person(data_source, result)
+            unified = unify_person(identities, people_id, name, email, user_id)
+            if unified is None:
+                continue
+            if unified[1]:
+                newids += 1
+            else:
+                reusedids += 1
+    pool.close()
+    pool.join()
+
+    identities.flush()
     db_ids.commit()
-    db_database_ds.commit()
+    for db_database_ds, cursor_ds in dbs_ds.values():
+        db_database_ds.commit()
 
     logging.info (" Total analyzed: " + str(total))
     logging.info (" New identities: " + str(newids))
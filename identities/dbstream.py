@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+#
+# dbstream.py
+#
+# Streaming reader for big tables (people, identities...). Rows are read
+# with a MySQLdb server side cursor (SSCursor), so they are not stored in
+# the client all together, and are fetched in batches of fetch_batch rows.
+#
+# While the rows of a stream are not all read, the connection can not run
+# other queries. Streams must also be read without long pauses: the server
+# cuts a stream left unread longer than net_write_timeout (60 seconds by
+# default). Scripts that run queries while processing the rows read them
+# with a buffered cursor instead.
+#
+
+import MySQLdb.cursors
+
+# Default number of rows fetched from the server per round-trip
+FETCH_BATCH = 10000
+
+
+def stream_batches(db, query, params=None, fetch_batch=FETCH_BATCH):
+    """Generator for the rows of query, as lists of up to fetch_batch rows.
+
+    db: MySQLdb connection to use
+    params: parameters for the query, as in cursor.execute
+    fetch_batch: number of rows fetched from the server at once
+    """
+
+    cursor = db.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(fetch_batch)
+        while rows:
+            yield rows
+            rows = cursor.fetchmany(fetch_batch)
+    finally:
+        # Closing the cursor discards the rows not read yet
+        cursor.close()
+
+
+def stream_rows(db, query, params=None, fetch_batch=FETCH_BATCH):
+    """Generator for the rows of query, as tuples"""
+
+    for rows in stream_batches(db, query, params, fetch_batch):
+        for row in rows:
+            yield row
@@ -37,6 +37,8 @@ import sys
 import re
 from optparse import OptionGroup, OptionParser
 
+from dbstream import FETCH_BATCH
+
 def create_tables(db, connector, sortinghat = False):
 #   query = "DROP TABLE IF EXISTS domains"
 #   connector.execute(query)
@@ -105,6 +107,24 @@ def execute_query(connector, query):
    else:
       return []
 
+def read_batches(connector, query, first_key, fetch_batch=FETCH_BATCH):
+   """Generator for the rows of query, read fetch_batch rows at a time.
+
+   query selects the key of the table first, and has parameters for the
+   last key read and the number of rows. Batches are read with the
+   buffered cursor connector, so rows can be processed with queries in
+   between without the server cutting a stream (net_write_timeout).
+   """
+   key = first_key
+   while True:
+      connector.execute(query, (key, fetch_batch))
+      rows = connector.fetchall()
+      for row in rows:
+         yield row
+      if len(rows) < fetch_batch:
+         break
+      key = rows[-1][0]
+
 def getOptions():
     parser = OptionParser(usage='Usage: %prog [options]', 
                           description='Domains analysis detection using email addresses',
@@ -169,19 +189,25 @@ def main(db):
    cfg = getOptions()
    db, connector = connect(cfg)
    create_tables(db, connector, cfg.sortinghat)
-   query = "select upeople_id, identity from identities where type='email'"
+   query = "select id, upeople_id, identity from identities " + \
+           "where type='email' and id > %s order by id limit %s"
+   first_key = 0
    if (cfg.sortinghat):
        # query = "select uuid, email from identities where email is not NULL and email<>'None'"
-       query = "select uuid, email from identities"
-   people = execute_query(connector, query)
+       query = "select id, uuid, email from identities " + \
+               "where id > %s order by id limit %s"
+       first_key = ''
+   # identities are read in batches through their own cursor, while
+   # domains are queried and inserted using connector
+   people = read_batches(db.cursor(), query, first_key)
    rexp = "(.*@)(.*)"
 
    for person in people:
       if not cfg.sortinghat:
-         upeople_id = int(person[0])
+         upeople_id = int(person[1])
       else:
-         uuid = person[0]
-      email = str(person[1])
+         uuid = person[1]
+      email = str(person[2])
 
       if re.match(rexp, email):
          m = re.match(rexp, email)
@@ -26,6 +26,7 @@ import sys
 
 import MySQLdb
 
+from dbstream import stream_rows
 from sortinghat import api
 from sortinghat.db.database import Database
 from sortinghat.exceptions import NotFoundError, AlreadyExistsError
@@ -37,12 +38,12 @@ def main():
     args = parse_args()
 
     conn = open_database(args, args.database)
-    people_uidentities = retrieve_people_uidentities(conn.cursor())
-    people_upeople = retrieve_people_upeople(conn.cursor())
+    people_uidentities = retrieve_people_uidentities(conn)
+    people_upeople = retrieve_people_upeople(conn)
     close_database(conn)
 
     conn = open_database(args, args.identities)
-    enrollments = retrieve_upeople_companies(conn.cursor())
+    enrollments = retrieve_upeople_companies(conn)
     close_database(conn)
 
     identities = find_matches(people_uidentities, people_upeople, enrollments)
@@ -111,23 +112,21 @@ def enroll_identities(sh_db, identities, insert_orgs=False):
             except AlreadyExistsError, e:
                 pass
 
-def retrieve_people_uidentities(cursor):
+def retrieve_people_uidentities(conn):
     """Retrieve people uidentities mapping"""
 
     query = "SELECT people_id, uuid FROM people_uidentities"
-    cursor.execute(query)
-    results = cursor.fetchall()
+    results = stream_rows(conn, query)
 
     mapping = {r[0] : r[1] for r in results}
 
     return mapping
 
-def retrieve_people_upeople(cursor):
+def retrieve_people_upeople(conn):
     """Retrieve people uidentities mapping"""
 
     query = "SELECT upeople_id, people_id FROM people_upeople"
-    cursor.execute(query)
-    results = cursor.fetchall()
+    results = stream_rows(conn, query)
 
     mapping = {}
 
@@ -142,13 +141,12 @@ def retrieve_people_upeople(cursor):
 
     return mapping
 
-def retrieve_upeople_companies(cursor):
+def retrieve_upeople_companies(conn):
     """Retrieve upeople companies relationships"""
 
     query = "SELECT upeople_id, name, init, end FROM upeople_companies, companies "
     query += "WHERE company_id = companies.id"
-    cursor.execute(query)
-    results = cursor.fetchall()
+    results = stream_rows(conn, query)
 
     enrollments = {}
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import unittest
+
+from unifypeople import Identities, UnionFind
+
+
+class UnionFindTest(unittest.TestCase):
+
+    def test_ids_not_merged(self):
+        uf = UnionFind()
+        self.assertEqual(uf.find(7), 7)
+        self.assertEqual(uf.duplicates(), 0)
+
+    def test_union_keeps_lower_id(self):
+        uf = UnionFind()
+        self.assertEqual(uf.union(5, 3), 3)
+        self.assertEqual(uf.find(5), 3)
+        self.assertEqual(uf.find(3), 3)
+        self.assertEqual(uf.duplicates(), 1)
+
+    def test_union_is_transitive(self):
+        uf = UnionFind()
+        uf.union(4, 9)
+        uf.union(9, 2)
+        uf.union(6, 7)
+        uf.union(7, 4)
+        for id in [2, 4, 6, 7, 9]:
+            self.assertEqual(uf.find(id), 2)
+        self.assertEqual(uf.duplicates(), 4)
+
+    def test_union_same_set(self):
+        uf = UnionFind()
+        uf.union(1, 2)
+        uf.union(2, 3)
+        self.assertEqual(uf.union(3, 1), 1)
+        self.assertEqual(uf.duplicates(), 2)
+
+    def test_path_compression(self):
+        uf = UnionFind()
+        # Chain 5 -> 4 -> 3 -> 2 -> 1
+        for id in range(2, 6):
+            uf.parent[id] = id - 1
+        self.assertEqual(uf.find(5), 1)
+        for id in range(2, 6):
+            self.assertEqual(uf.parent[id], 1)
+
+
+class IdentitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.identities = Identities()
+
+    def test_find_lowercase(self):
+        self.identities.insert("John.Smith@Example.org", 1)
+        self.assertEqual(self.identities.find("john.smith@example.org"), 1)
+        self.assertEqual(self.identities.find("JOHN.SMITH@EXAMPLE.ORG"), 1)
+        self.assertEqual(self.identities.find("jsmith@example.org"), 0)
+
+    def test_find_dotted_name(self):
+        self.identities.insert("john.smith@example.org", 1)
+        self.assertEqual(self.identities.findDotted("John Smith"), 1)
+        self.assertEqual(self.identities.findDotted("john.smith"), 1)
+        self.assertEqual(self.identities.findDotted("Jane Smith"), 0)
+
+    def test_find_dotted_needs_spaces_or_dots(self):
+        self.identities.insert("jsmith@example.org", 1)
+        self.assertEqual(self.identities.findDotted("jsmith"), 0)
+
+    def test_find_dotted_first_in_sorted_order(self):
+        self.identities.insert("john.smith@mail.org", 2)
+        self.identities.insert("john.smith@example.org", 1)
+        self.identities.insert("john.smith@zzz.org", 3)
+        self.assertEqual(self.identities.findDotted("John Smith"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,8 +37,14 @@
 #
 
 import MySQLdb
+from array import array
 from optparse import OptionGroup, OptionParser
 
+from dbstream import stream_rows, FETCH_BATCH
+
+# Rows inserted in people_upeople per round-trip
+BATCH_SIZE = 10000
+
 class Identities:
     """Keeps track of identities assigned to unique ids.
 
@@ -64,17 +70,16 @@ class Identities:
         and compared to anything before @. We compare only in cases
         of strings with spaces or dots (otherwise, too much false
         positives).
+        Uses the index of local parts maintained by insert, so it
+        does not need to go through all stored identities.
         Returns the unique id for an identity, or 0 if not found"""
 
         if (' ' in identity) or ('.' in identity):
             identity = identity.lower().replace(' ', '.')
         else:
-            print "**Not checking: " + identity
             return (0)
-        for element in sorted(self.stored):
-            if identity == element.split('@',1)[0]:
-                print "**Found: " + identity + " / " + element
-                return (self.stored[element])
+        if identity in self.localParts:
+            return (self.localParts[identity][1])
         return (0)
 
     def insert (self, identity, uid):
@@ -82,6 +87,12 @@ class Identities:
 
         identity = identity.lower()
         self.stored[identity] = uid
+        # Index by local part (anything before @). If several identities
+        # share it, keep the first one in sorted order.
+        localPart = identity.split('@',1)[0]
+        if localPart not in self.localParts or \
+                identity <= self.localParts[localPart][0]:
+            self.localParts[localPart] = (identity, uid)
 
     def get_all (self):
         """Get all identities, sorted"""
@@ -100,9 +111,60 @@ class Identities:
         """Create the dictionary for stored identities.
 
         Key for the dictionary is identity, value is unique id.
+        Key for the local parts index is anything before @ in identity,
+        value is (identity, unique id).
         """
 
         self.stored = {}
+        self.localParts = {}
+
+class UnionFind:
+    """Disjoint sets of people ids, merged transitively.
+
+    Only ids merged into another set are stored, so memory grows with
+    the number of duplicates, not with the number of people.
+    The root of each set is the lower id in it, which is used as
+    the "cannonical" (unique) id.
+    """
+
+    def find (self, id):
+        """Returns the cannonical id for id, compressing the path to it"""
+
+        root = id
+        while root in self.parent:
+            root = self.parent[root]
+        # Path compression: point every id in the chain to the root
+        while id != root:
+            next = self.parent[id]
+            self.parent[id] = root
+            id = next
+        return (root)
+
+    def union (self, id1, id2):
+        """Merges the sets of id1 and id2. Returns the cannonical id"""
+
+        root1 = self.find (id1)
+        root2 = self.find (id2)
+        if root1 == root2:
+            return (root1)
+        if root2 < root1:
+            (root1, root2) = (root2, root1)
+        self.parent[root2] = root1
+        return (root1)
+
+    def duplicates (self):
+        """Number of ids merged into a lower one"""
+
+        return (len(self.parent))
+
+    def __init__ (self):
+        """Create the dictionary of parents.
+
+        Key is an id merged into another set, value is its parent id.
+        Ids not in the dictionary are roots.
+        """
+
+        self.parent = {}
 
 def strPerson (person):
     """Get a string out of a (name,email) dictionary."""
@@ -128,22 +190,24 @@ def getOptions():
                      default='3306')
     parser.add_option('-i', '--incremental', dest='incremental',
                       help='yes/no incremental analysis', default='yes')
+    parser.add_option('--fetch-batch', dest='fetch_batch', type='int',
+                      help='Rows read from people per round-trip',
+                      default=FETCH_BATCH)
 
     (ops, args) = parser.parse_args()
 
     return ops
 
 
-def generate_upeople(personsById):
-    upeople = []
-    for id in sorted(personsById):
-        if id in dupIds:
-            uid = dupIds[id]
-        else:
-            uid = id
-        upeople.append((id, uid))
+def generate_upeople(ids, merged):
+    """Generate (people_id, upeople_id) tuples, sorted by people_id.
+
+    ids: people ids, as an iterable of sorted ints
+    merged: UnionFind with the duplicates found
+    """
 
-    return upeople
+    for id in ids:
+        yield (id, merged.find(id))
 
 
 def create_schema_uids(cursor, db):
@@ -169,6 +233,19 @@ def create_schema_uids(cursor, db):
     db.commit()
 
 
+def insert_many(cursor, query, rows):
+    """Insert rows (any iterable) with executemany, BATCH_SIZE at a time"""
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= BATCH_SIZE:
+            cursor.executemany(query, chunk)
+            chunk = []
+    if chunk:
+        cursor.executemany(query, chunk)
+
+
 def create_schema(cursor, db, upeople):
 
     print "Now creating people_upeople table (this may take a while)..."
@@ -181,7 +258,7 @@ def create_schema(cursor, db, upeople):
     cursor.execute("ALTER TABLE people_upeople DISABLE KEYS")
     db.commit()
 
-    cursor.executemany("""INSERT INTO people_upeople (people_id, upeople_id)
+    insert_many(cursor, """INSERT INTO people_upeople (people_id, upeople_id)
        VALUES (%s, %s)""", upeople)
     cursor.execute("ALTER TABLE people_upeople ENABLE KEYS")
     db.commit()
@@ -243,164 +320,166 @@ def check_tables(cursor):
 
 
 def update_schema(cursor, db, upeople):
-  
+    """Add to the schema the people not yet in people_upeople.
+
+    upeople: (people_id, upeople_id) tuples for all people, as
+    produced by generate_upeople. It is read just once.
+    """
+
     query = """select distinct p.id, p.name, p.email 
                from people p 
                where p.id not in 
                      (select distinct people_id 
                       from people_upeople);"""
 
-    results = execute_query(cursor, query)
-    # print results
-    for result in results:
-        # print result
-        # check if the algorithm was able to detect duplicated identities
-        # with this set of developers. This is done, checking if the people_id
-        # is different from the upeople_id in the tuple upeople
-        for person in upeople:
-            if int(result[0]) == int(person[0]):
-                #This is one of the new comers to the community
-                if int(person[0]) <> int(person[1]):
-                    # a new identity for a developer was found by the algorithm
-                    query = "insert into people_upeople(people_id, upeople_id) " +\
-                            " values(" + str(person[0]) + ", " + str(person[1]) + ")"
-                    execute_query(cursor, query)
-                    #To be fixed: this action will probably introduce repeated emails or names
-                    #at some point
-                    ident = str(result[1]).replace("'", "\\'")
-                    query = "INSERT INTO identities(upeople_id, identity, type) " +\
-                            " values(" + str(person[1]) + ", '" + ident + "', 'name')"
-                    execute_query(cursor, query)
-                    query = "INSERT INTO identities(upeople_id, identity, type) " +\
-                            " values(" + str(person[1]) + ", '" + result[2] + "', 'email')"
-                else:
-                    query = "select max(id) from upeople"
-                    values = execute_query(cursor, query)
-                    max_id = int(values[0][0]) + 1
-                    # a new developer has been found by the algorithm
-                    query = "insert into people_upeople(people_id, upeople_id) " +\
-                            " values(" + str(person[0]) + ", " + str(max_id) + ")"
-                    execute_query(cursor, query)
-                    ident = str(result[1]).replace("'", "\\'")
-                    query = "insert into upeople(id, identifier) " +\
-                            " values(" + str(max_id) + ", '" + ident + "')"
-                    execute_query(cursor, query)
-                    query = "INSERT INTO identities(upeople_id, identity, type) " +\
-                            " values(" + str(max_id) + ", '" + ident + "', 'name')"
-                    execute_query(cursor, query)
-                    query = "INSERT INTO identities(upeople_id, identity, type) " +\
-                            " values(" + str(max_id) + ", '" + result[2] + "', 'email')"
-                    execute_query(cursor, query)
-
-
-# Open database connection and get all data in people table
-# into people list.
-
-cfg = getOptions()
-
-incremental = True
-if cfg.incremental == 'no':
-    incremental = False
-
-db = MySQLdb.connect(user = cfg.db_user, passwd = cfg.db_password,  db = cfg.db_database)
-
-cursor = db.cursor()
-
-if (check_tables(cursor) == False):
-    print("Tables does not exists. Incremental off")
-    incremental = False
-
-if not incremental:
-    create_schema_uids(cursor, db)
-
-query = """SELECT *
-           FROM people, scmlog
-           WHERE people.id = scmlog.author_id
-           GROUP BY people.id"""
-
-query = "SELECT * FROM people"
-
-# Set all name retrieval in utf8
-cursor.execute("SET NAMES utf8")
-# execute SQL query using execute() method.
-cursor.execute(query)
-people = cursor.fetchall()
-
-# Create objects for checking identities
-identitiesNames = Identities()
-identitiesEmails = Identities()
-# Entries in people, as a dictionary keyed by id
-personsById = {}
-# Ids that are duplicate. Key is the id, value is the "original" id,
-#  which we use as unique id (it is the lower one of the dups)
-dupIds = {}
-
-# Now, check all identities in persons
-for person in people:
-    try:
-        (id, name, email) = person
-    except:
-        # Not a cvsanaly db just create empty tables
-        break
-    # In Linux kernel, there are several "???", "", etc. names
-    # Let's substitute them for something meaningful (the id)
-    if name in ("???", "?", "", "root"):
-        name = "**Unknown**" + "%3d" % id
-    # In SVN we don't have the email
-    if email is None:
-        email = ""
-    personsById[id] = {'name': name, 'email': email}
-    # Is name in names?
-    uidName = identitiesNames.find (name)
-    # Is name in emails? (probably it is actually an email)
-    uidNameEmail = identitiesEmails.find (name)
-    # Is name, lowercased and dotted, in emails?
-    #uidNameEmailDotted = identitiesEmails.findDotted (name)
-    # Is email in emails?
-    if email == "":
-        uidEmail = 0
+    # New comers to the community, keyed by people_id
+    newPeople = {}
+    for result in execute_query(cursor, query):
+        newPeople[int(result[0])] = result
+    if len(newPeople) == 0:
+        return
+
+    values = execute_query(cursor, "select max(id) from upeople")
+    max_id = values[0][0]
+    if max_id is None: max_id = 0
+    max_id = int(max_id)
+
+    # upeople id assigned to each new comer in this run
+    assigned = {}
+    people_upeople = []
+    new_upeople = []
+    new_identities = []
+    for (people_id, uid) in upeople:
+        people_id = int(people_id)
+        if people_id not in newPeople:
+            continue
+        result = newPeople[people_id]
+        uid = int(uid)
+        if people_id <> uid:
+            # a new identity for a developer was found by the algorithm.
+            # The unique id may be a new comer too, already assigned
+            # (it is the lower id, so it was processed before)
+            upeople_id = assigned.get(uid, uid)
+        else:
+            # a new developer has been found by the algorithm
+            max_id += 1
+            upeople_id = max_id
+            new_upeople.append((upeople_id, str(result[1])))
+        assigned[people_id] = upeople_id
+        people_upeople.append((people_id, upeople_id))
+        #To be fixed: this action will probably introduce repeated emails or names
+        #at some point
+        new_identities.append((upeople_id, str(result[1]), 'name'))
+        if result[2]:
+            new_identities.append((upeople_id, result[2], 'email'))
+
+    insert_many(cursor, """insert into people_upeople(people_id, upeople_id)
+                           values(%s, %s)""", people_upeople)
+    insert_many(cursor, """insert into upeople(id, identifier)
+                           values(%s, %s)""", new_upeople)
+    insert_many(cursor, """INSERT INTO identities(upeople_id, identity, type)
+                           values(%s, %s, %s)""", new_identities)
+    db.commit()
+    print str(len(people_upeople)) + " new people added, " + \
+        str(len(new_upeople)) + " of them as new unique identities."
+
+
+if __name__ == '__main__':
+    # Open database connection and get all data in people table
+    # into people list.
+
+    cfg = getOptions()
+
+    incremental = True
+    if cfg.incremental == 'no':
+        incremental = False
+
+    db = MySQLdb.connect(user = cfg.db_user, passwd = cfg.db_password,  db = cfg.db_database)
+
+    cursor = db.cursor()
+
+    if (check_tables(cursor) == False):
+        print("Tables does not exists. Incremental off")
+        incremental = False
+
+    if not incremental:
+        create_schema_uids(cursor, db)
+
+    query = """SELECT *
+               FROM people, scmlog
+               WHERE people.id = scmlog.author_id
+               GROUP BY people.id"""
+
+    query = "SELECT * FROM people ORDER BY id"
+
+    # Set all name retrieval in utf8
+    cursor.execute("SET NAMES utf8")
+    # Create objects for checking identities
+    identitiesNames = Identities()
+    identitiesEmails = Identities()
+    # All ids in people, as a compact array of ints
+    peopleIds = array('l')
+    # Ids that are duplicate, as disjoint sets. The "original" id of each set,
+    #  which we use as unique id, is the lower one of the dups
+    dupIds = UnionFind()
+
+    # Now, check all identities in persons, streamed from people in batches
+    for person in stream_rows(db, query, fetch_batch=cfg.fetch_batch):
+        try:
+            (id, name, email) = person
+        except:
+            # Not a cvsanaly db just create empty tables
+            break
+        # In Linux kernel, there are several "???", "", etc. names
+        # Let's substitute them for something meaningful (the id)
+        if name in ("???", "?", "", "root"):
+            name = "**Unknown**" + "%3d" % id
+        # In SVN we don't have the email
+        if email is None:
+            email = ""
+        peopleIds.append(id)
+        # Is name in names?
+        uidName = identitiesNames.find (name)
+        # Is name in emails? (probably it is actually an email)
+        uidNameEmail = identitiesEmails.find (name)
+        # Is name, lowercased and dotted, in emails?
+        uidNameEmailDotted = identitiesEmails.findDotted (name)
+        # Is email in emails?
+        if email == "":
+            uidEmail = 0
+        else:
+            uidEmail = identitiesEmails.find (email)
+        foundIds = [uidName, uidNameEmail, uidEmail, uidNameEmailDotted]
+        # Merge this id with all the duplicates found. Identities store
+        # any id of a set, find() returns always the cannonical one
+        for uid in foundIds:
+            if uid != 0:
+                dupIds.union (id, uid)
+        if uidName == 0:
+            identitiesNames.insert (name, id)
+        if uidEmail == 0:
+            identitiesEmails.insert (email, id)
+
+    # Uncomment next lines for debugging results
+
+    #for id in peopleIds:
+    #    if dupIds.find(id) != id:
+    #        print str(id) + " is a duplicate of " + str(dupIds.find(id))
+    #print "== Names =="
+    #identitiesNames.print_all("Name: ")
+    #print "== Email addresses =="
+    #identitiesEmails.print_all(":Email: ")
+    print str(dupIds.duplicates()) + " duplicate ids found."
+
+    # Create unique people table
+    # Each row is a people identifier, and a unique identifier
+    # Several people identifiers could have the same unique identifier
+
+    upeople = generate_upeople(peopleIds, dupIds)
+    if not incremental:
+        create_schema(cursor, db, upeople)
     else:
-        uidEmail = identitiesEmails.find (email)
-    #foundIds = [uidName, uidNameEmail, uidEmail, uidNameEmailDotted]
-    foundIds = [uidName, uidNameEmail, uidEmail]
-    foundIds = [el for el in foundIds if el != 0]
-    foundIds = sorted (list (set (foundIds)))
-    if len(foundIds) > 0:
-        # There is at least one duplicate. First one is the "unique"
-        duplicates = foundIds[1:]
-        duplicates.append(id)
-        for dup in duplicates:
-            dupIds[dup] = foundIds[0]
-        # Use the unique id for inserting in identities tables mapping
-        # so the identifier is related to the unique identity
-        id = foundIds[0]
-    if uidName == 0:
-        identitiesNames.insert (name, id)
-    if uidEmail == 0:
-        identitiesEmails.insert (email, id)
-    
-# Uncomment next lines for debugging results
-
-#for id in sorted(dupIds):
-#    print str(id) + " (" + strPerson(personsById[id]) + \
-#        ") is a duplicate of " + \
-#        str(dupIds[id]) + " (" + strPerson(personsById[dupIds[id]]) + ")"
-#print "== Names =="
-#identitiesNames.print_all("Name: ")
-#print "== Email addresses =="
-#identitiesEmails.print_all(":Email: ")
-print str(len(dupIds)) + " duplicate ids found."
-print dupIds
-
-# Create unique people table
-# Each row is a people identifier, and a unique identifier
-# Several people identifiers could have the same unique identifier
-
-upeople = generate_upeople(personsById)
-if not incremental:
-    create_schema(cursor, db, upeople)
-else:
-    update_schema(cursor, db, upeople)
-
-db.close()
-print "Done."
+        update_schema(cursor, db, upeople)
+
+    db.close()
+    print "Done."
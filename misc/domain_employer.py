@@ -31,10 +31,14 @@
 # employer
 
 
-import MySQLdb
+import os
 import sys
 import re
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
+
 def create_tables(db, connector):
    query = "DROP TABLE IF EXISTS companies"
    connector.execute(query)
@@ -63,24 +67,15 @@ def create_tables(db, connector):
    return
 
 def connect(database):
+   # connection to database, released when leaving the with block
    user = 'xxx'
    password = 'xxx'
    host = 'xxx'
-   try:
-      db =  MySQLdb.connect(host,user,password,database)
-      return db, db.cursor()
-   except:
-      print("Database connection error")
-
-
-def execute_query(connector, query):
-   results = int (connector.execute(query))
-   cont = 0
-   if results > 0:
-      result1 = connector.fetchall()
-      return result1
-   else:
-      return []
+   return dbaccess.connection(database, user, password, host)
+
+
+def execute_query(connector, query, params=None):
+   return dbaccess.execute(connector, query, params)
 
 def parse_domain_companies(dc_file):
    
@@ -110,10 +105,13 @@ def main(database, dc_file):
 
    domains = domain_companies.keys()
    domains = list(set(domains))
-    
-   pe_com = {}
 
-   db, connector = connect(database)
+   with connect(database) as db:
+      insert_companies(db, companies, domains, domain_companies)
+
+def insert_companies(db, companies, domains, domain_companies):
+   pe_com = {}
+   connector = db.cursor()
 
    create_tables(db, connector)
 
@@ -167,15 +165,13 @@ def main(database, dc_file):
             continue
          company_id = int(company)
          query = "INSERT INTO upeople_companies(upeople_id, company_id, init, end) " + \
-                 "VALUES(" + str(author_id) + "," + \
-                             str(company_id) + "," + \
-                             "'1900-01-01', '2100-01-01' );"
-         connector.execute(query)
+                 "VALUES(%s, %s, '1900-01-01', '2100-01-01')"
+         execute_query(connector, query, (author_id, company_id))
    #inserting companies in companies table      
    for company in companies:
-      query = "INSERT INTO companies(name) " +\
-              "VALUES('" + str(company) + "');"
-      connector.execute(query)
+      query = "INSERT INTO companies(name) VALUES(%s)"
+      execute_query(connector, query, (str(company),))
+   db.commit()
       
 
 
@@ -33,29 +33,24 @@
 # duplicated
 
 
-import MySQLdb
+import os
 import sys
 import re
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
+
 def connect(database):
+   # connection to database, released when leaving the with block
    user = 'xxx'
    password = 'xxx'
    host = 'xxx'
-   try:
-      db =  MySQLdb.connect(host,user,password,database)
-      return db, db.cursor()
-   except:
-      print("Database connection error")
+   return dbaccess.connection(database, user, password, host)
 
 
-def execute_query(connector, query):
-   results = int (connector.execute(query))
-   cont = 0
-   if results > 0:
-      result1 = connector.fetchall()
-      return result1
-   else:
-      return []
+def execute_query(connector, query, params=None):
+   return dbaccess.execute(connector, query, params)
 
 
 def retrieve_companies_info(connector):
@@ -127,15 +122,15 @@ def insert_dates(people_companies):
 def insert_company(connector, company):
    company_id = -1
 
-   query = "select * from companies where name = '"+company+"'"
-   results = execute_query(connector, query)
+   query = "select * from companies where name = %s"
+   results = execute_query(connector, query, (company,))
    if len(results) == 0:
       # new company detected
-      query = "insert into companies(name) values('"+company+"')"
-      execute_query(connector, query)
+      query = "insert into companies(name) values(%s)"
+      execute_query(connector, query, (company,))
       
-      query = "select id from companies where name='"+company.title()+"'"
-      results = execute_query(connector, query)
+      query = "select id from companies where name = %s"
+      results = execute_query(connector, query, (company.title(),))
       company_id = int(results[0][0])
 
    return company_id
@@ -144,12 +139,16 @@ def main(database, ee_file):
    # database: resultant database
    # ee_file:  email employer file
 
-   db, connector = connect(database)
-
    fd = open(ee_file, 'r')
    people_data = fd.readlines()
    fd.close()
 
+   with connect(database) as db:
+      update_companies(db, people_data)
+
+def update_companies(db, people_data):
+   connector = db.cursor()
+
    companies = retrieve_companies_info(connector)
 
    people_companies = parse_people_data(people_data)
@@ -172,8 +171,8 @@ def main(database, ee_file):
             companies[company] = company_id
 
          # Retrieving data from email
-         query = "select upeople_id from identities where identity = '"+ email +"' limit 1;"
-         results = execute_query(connector, query)
+         query = "select upeople_id from identities where identity = %s limit 1"
+         results = execute_query(connector, query, (email,))
          if not len(results) > 0:
             continue # simply ignored
          upeople_id = int(results[0][0])
@@ -181,22 +180,20 @@ def main(database, ee_file):
          # Inserting new companies timeframes into table
 
          # First, checking that this tuple exists:
-         query = "select * from upeople_companies where upeople_id=" + str(upeople_id) +\
-                  " and company_id=" + str(companies[company.lower()]) + ";"
-         results = execute_query(connector, query)
+         company_id = companies[company.lower()]
+         query = "select * from upeople_companies where upeople_id = %s and company_id = %s"
+         results = execute_query(connector, query, (upeople_id, company_id))
          if len(results) > 0:
             # there exist previous data there (ideally initialized to generic values)
-            query = "update upeople_companies set init='" + init_date + "', end='" + end_date + "'" +\
-                    "where upeople_id=" + str(upeople_id) + " and company_id=" + str(companies[company.lower()]) + ";"
-
+            query = "update upeople_companies set init = %s, end = %s " +\
+                    "where upeople_id = %s and company_id = %s"
+            params = (init_date, end_date, upeople_id, company_id)
          else:
             query = "insert into upeople_companies(upeople_id, company_id, init, end) " + \
-                     "values("+ str(upeople_id) + ", " + \
-                     str(companies[company.lower()]) + ", " + \
-                     "'" + init_date + "', " + \
-                     "'" + end_date + "');"
+                    "values(%s, %s, %s, %s)"
+            params = (upeople_id, company_id, init_date, end_date)
 
-         execute_query(connector, query)
+         execute_query(connector, query, params)
 
 
    db.commit()
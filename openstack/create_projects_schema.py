@@ -28,7 +28,12 @@
 
 import yaml
 
-import MySQLdb
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
 
 from optparse import OptionParser
 
@@ -112,31 +117,13 @@ def create_projects_schema(cursor):
 
 # From GrimoireSQL
 def execute_query (cursor, sql):
-    result = {}
     cursor.execute("SET NAMES utf8")
-    cursor.execute(sql)
-    rows = cursor.rowcount
-    columns = cursor.description
-
-    for column in columns:
-        result[column[0]] = []
-    if rows > 1:
-        for value in cursor.fetchall():
-            for (index,column) in enumerate(value):
-                result[columns[index][0]].append(column)
-    elif rows == 1:
-        value = cursor.fetchone()
-        for i in range (0, len(columns)):
-            result[columns[i][0]] = value[i]
-    return result
+    return dbaccess.execute_query(cursor, sql)
 
 def connect(database, user, password):
+   # connection to database, released when leaving the with block
    host = 'localhost'
-   try:
-      db =  MySQLdb.connect(host,user,password,database)
-      return db.cursor()
-   except:
-      print("Database connection error")
+   return dbaccess.connection(database, user, password, host)
 
 
 def insert_program(program, program_name, cursor):
@@ -266,29 +253,30 @@ if __name__ == '__main__':
     opts = read_options()
 
     # Init db schema and connector
-    db_cursor = connect(opts.dbcvsanaly, opts.dbuser, opts.dbpassword)
-    create_projects_schema(db_cursor)
+    with connect(opts.dbcvsanaly, opts.dbuser, opts.dbpassword) as db:
+        db_cursor = db.cursor()
+        create_projects_schema(db_cursor)
 
-    # Parse yaml file into dictionary
-    stream = open(opts.file_path, 'r')
-    programs = yaml.load(stream)
+        # Parse yaml file into dictionary
+        stream = open(opts.file_path, 'r')
+        programs = yaml.load(stream)
     
-    # Insert each of the programs information into the
-    # db schema
-    programs_list = []
-    for program_name in programs.keys():
-        programs_list.append(program_name)
-        insert_program(programs[program_name], program_name, db_cursor)
-
-    releases_programs = {}
-    # Each OpenStack release contains a subset
-    # of all of the official programs (except typically
-    # the last release that contains all of them)
-    # Thus, a release is considered as a meta-project that 
-    # contains a list of subprojects (that contains repositories)
-    releases_programs = associated_projects(programs, programs_list)
-    insert_releases_programs(releases_programs, programs_list, db_cursor)
-
-    # And finally, insert projects per program
-    insert_projects_per_program(programs, programs_list, db_cursor, opts.dbgerrit, opts.dbbicho)
+        # Insert each of the programs information into the
+        # db schema
+        programs_list = []
+        for program_name in programs.keys():
+            programs_list.append(program_name)
+            insert_program(programs[program_name], program_name, db_cursor)
+
+        releases_programs = {}
+        # Each OpenStack release contains a subset
+        # of all of the official programs (except typically
+        # the last release that contains all of them)
+        # Thus, a release is considered as a meta-project that 
+        # contains a list of subprojects (that contains repositories)
+        releases_programs = associated_projects(programs, programs_list)
+        insert_releases_programs(releases_programs, programs_list, db_cursor)
+
+        # And finally, insert projects per program
+        insert_projects_per_program(programs, programs_list, db_cursor, opts.dbgerrit, opts.dbbicho)
 
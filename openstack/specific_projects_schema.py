@@ -28,7 +28,12 @@
 
 import yaml
 
-import MySQLdb
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+import dbaccess
 
 from optparse import OptionParser
 
@@ -115,31 +120,13 @@ def create_projects_schema(cursor):
 
 # From GrimoireSQL
 def execute_query (cursor, sql):
-    result = {}
     cursor.execute("SET NAMES utf8")
-    cursor.execute(sql)
-    rows = cursor.rowcount
-    columns = cursor.description
-
-    for column in columns:
-        result[column[0]] = []
-    if rows > 1:
-        for value in cursor.fetchall():
-            for (index,column) in enumerate(value):
-                result[columns[index][0]].append(column)
-    elif rows == 1:
-        value = cursor.fetchone()
-        for i in range (0, len(columns)):
-            result[columns[i][0]] = value[i]
-    return result
+    return dbaccess.execute_query(cursor, sql)
 
 def connect(database, user, password):
+   # connection to database, released when leaving the with block
    host = 'localhost'
-   try:
-      db =  MySQLdb.connect(host,user,password,database)
-      return db.cursor()
-   except:
-      print("Database connection error")
+   return dbaccess.connection(database, user, password, host)
 
 
 def insert_program(program, program_name, cursor):
@@ -378,25 +365,26 @@ if __name__ == '__main__':
     opts = read_options()
 
     # Init db schema and connector
-    db_cursor = connect(opts.dbcvsanaly, opts.dbuser, opts.dbpassword)
-    create_projects_schema(db_cursor)
+    with connect(opts.dbcvsanaly, opts.dbuser, opts.dbpassword) as db:
+        db_cursor = db.cursor()
+        create_projects_schema(db_cursor)
 
-    # Parse yaml file into dictionary
-    stream = open(opts.file_path, 'r')
-    programs = yaml.load(stream)
+        # Parse yaml file into dictionary
+        stream = open(opts.file_path, 'r')
+        programs = yaml.load(stream)
     
-    # There are 2 main sets of programs:
-    # - OpenStack Software that contains all programs with repos using the 
-    #   integrated or incubated flag
-    # - Rest of the programs, all grouped as in the yaml file. Their repos
-    #   do not use the integrated or incubated flag at any time.
-    openstack_sw_programs = divide_programs(programs)
-
-    # Insert OpenStack Software programs
-    insert_openstack_sw_programs(openstack_sw_programs["OpenStack Software"],
-                                 programs, db_cursor, opts.dbgerrit, opts.dbbicho)
-
-    # Insert Others programs
-    insert_other_programs(openstack_sw_programs["Others"],
-                           programs, db_cursor, opts.dbgerrit, opts.dbbicho)
+        # There are 2 main sets of programs:
+        # - OpenStack Software that contains all programs with repos using the 
+        #   integrated or incubated flag
+        # - Rest of the programs, all grouped as in the yaml file. Their repos
+        #   do not use the integrated or incubated flag at any time.
+        openstack_sw_programs = divide_programs(programs)
+
+        # Insert OpenStack Software programs
+        insert_openstack_sw_programs(openstack_sw_programs["OpenStack Software"],
+                                     programs, db_cursor, opts.dbgerrit, opts.dbbicho)
+
+        # Insert Others programs
+        insert_other_programs(openstack_sw_programs["Others"],
+                               programs, db_cursor, opts.dbgerrit, opts.dbbicho)
 
@@ -27,10 +27,37 @@ import logging
 import MySQLdb
 import datetime
 import smtplib
+import sqlite3
+import time
 import ConfigParser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "common"))
+from dbaccess import get_pool
+
+# Default number of databases checked at the same time
+WORKERS = 8
+# Default seconds a freshness query may run before it is reported as slow
+QUERY_TIMEOUT = 300
+CONNECT_TIMEOUT = 10
+# Default seconds all the databases may take to be checked
+RUN_TIMEOUT = 3600
+
+# Status of a database check. Only OK checks have an age in days
+OK = 'ok'
+SLOW = 'slow'
+UNREACHABLE = 'unreachable'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Query interrupted by max_execution_time (MySQL) or max_statement_time (MariaDB)
+TIMEOUT_ERRORS = (3024, 1969)
+# Server not available or connection lost
+CONNECTION_ERRORS = (2002, 2003, 2005, 2006, 2013)
 
 QUERIES = {
     "db_cvsanaly": "SELECT MAX(date) FROM scmlog;",
@@ -46,6 +73,27 @@ QUERIES = {
     "db_eventizer": "SELECT MAX(updated) FROM events;"
 }
 
+# (table, column) pairs read by each query
+MONITORED = {
+    "db_cvsanaly": [("scmlog", "date")],
+    "db_gerrit": [("issues_ext_gerrit", "mod_date")],
+    "db_mlstats": [("messages", "first_date")],
+    "db_bicho": [("changes", "changed_on"), ("issues", "submitted_on"),
+                 ("comments", "submitted_on")],
+    "db_irc": [("irclog", "date")],
+    "db_pullpo": [("pull_requests", "updated_at")],
+    "db_sibyl": [("answers", "submitted_on"), ("questions", "last_activity_at")],
+    "db_releases": [("releases", "updated_on")],
+    "db_mediawiki": [("wiki_pages_revs", "date")],
+    "db_downloads": [("downloads_month", "date")],
+    "db_eventizer": [("events", "updated")]
+}
+
+# Default days around the threshold within which fast mode runs the exact query
+MARGIN = 1
+# Default days of history shown by the trend report
+TREND_DAYS = 30
+
 def get_args():
     parser = ArgumentParser(usage='Usage: %(prog)s [options]',
                             description='Checks data freshness in SQL databases',
@@ -56,6 +104,28 @@ def get_args():
     parser.add_argument('--conf', dest='config_file',
                         help='Configuration file',
                         required=False)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='Databases checked at the same time (default %d)' % WORKERS,
+                        required=False, default=WORKERS)
+    parser.add_argument('--timeout', dest='timeout', type=int,
+                        help='Seconds before a query is reported as slow (default %d)' % QUERY_TIMEOUT,
+                        required=False, default=QUERY_TIMEOUT)
+    parser.add_argument('--run-timeout', dest='run_timeout', type=int,
+                        help='Seconds to check all the databases; the ones not checked by then are reported as skipped (default %d)' % RUN_TIMEOUT,
+                        required=False, default=RUN_TIMEOUT)
+    parser.add_argument('--fast', dest='fast',
+                        help='Estimate ages from information_schema, querying only databases close to their threshold',
+                        required=False, action='store_true')
+    parser.add_argument('--margin', dest='margin', type=int,
+                        help='Days before the threshold to run the exact query in fast mode (default %d)' % MARGIN,
+                        required=False, default=MARGIN)
+    parser.add_argument('--ttl', dest='ttl', type=int,
+                        help='Minutes a check stored in the history is reused instead of checking again (default 0)',
+                        required=False, default=0)
+    parser.add_argument('--trend', dest='trend', type=int, nargs='?',
+                        const=TREND_DAYS, metavar='DAYS',
+                        help='Print the lag trends of the last DAYS days stored in the history (default %d) and exit' % TREND_DAYS,
+                        required=False)
     args = parser.parse_args()
 
     if len(sys.argv)==1:
@@ -80,18 +150,321 @@ def get_databases(file_path):
             project_dbs[d] = Config.get('generic',d)
     return project_dbs
 
-def check_db_freshness(dbinfo, db_user, db_pass):
-    db=MySQLdb.connect(user=db_user,passwd=db_pass,db=dbinfo[1])
-    c=db.cursor()
+def get_db_server(file_path, default_host, default_port):
+    # Dashboards may have their databases in their own server
+    Config = ConfigParser.ConfigParser()
+    Config.read(file_path)
 
-    c.execute(QUERIES[dbinfo[0]])
-    updated_on = c.fetchone()[0]
+    host = default_host
+    port = default_port
+    if Config.has_option('generic', 'db_host'):
+        host = Config.get('generic', 'db_host')
+    if Config.has_option('generic', 'db_port'):
+        port = int(Config.get('generic', 'db_port'))
+    return host, port
+
+def set_query_timeout(cursor, timeout):
+    # Server side limit for the queries of the session. Servers without
+    # any of these variables are limited by the client deadline only
+    for query in ("SET SESSION max_execution_time = %d" % (timeout * 1000),
+                  "SET SESSION max_statement_time = %d" % timeout):
+        try:
+            cursor.execute(query)
+            return
+        except MySQLdb.Error:
+            pass
+
+def check_db_freshness(dbinfo, db_user, db_pass, host='localhost', port=3306,
+                       timeout=QUERY_TIMEOUT):
+    """Returns (status, days) for dbinfo, a (kind, database name) pair.
+
+    The query runs on a pooled connection to host, reused for all the
+    databases there. days is 9999 if there is no data, None if the
+    database could not be checked.
+    """
+    pool = get_pool('information_schema', db_user, db_pass, host, port,
+                    connect_timeout=CONNECT_TIMEOUT)
+    try:
+        db = pool.get()
+    except MySQLdb.Error, e:
+        logging.error("Can not connect to %s:%s: %s" % (host, port, e))
+        return UNREACHABLE, None
+
+    try:
+        db.select_db(dbinfo[1])
+        c = db.cursor()
+        set_query_timeout(c, timeout)
+        c.execute(QUERIES[dbinfo[0]])
+        updated_on = c.fetchone()[0]
+        c.close()
+    except MySQLdb.Error, e:
+        db.close()
+        code = e.args[0] if e.args else None
+        if code in TIMEOUT_ERRORS:
+            return SLOW, None
+        elif code in CONNECTION_ERRORS:
+            logging.error("Connection to %s:%s lost: %s" % (host, port, e))
+            return UNREACHABLE, None
+        logging.error("Error checking %s: %s" % (dbinfo[1], e))
+        return FAILED, None
+
+    pool.put(db)
 
     try:
         delta = datetime.datetime.now() - updated_on
-        return delta.days
+        return OK, delta.days
     except:
-        return 9999
+        return OK, 9999
+
+def probe_databases(probes, db_user, db_pass, workers=WORKERS,
+                    timeout=QUERY_TIMEOUT, run_timeout=RUN_TIMEOUT):
+    """Checks the freshness of probes, workers databases at a time.
+
+    probes: list of (dashboard, (kind, database name), (host, port))
+    Returns {probe: (status, days)}. Once a host is unreachable, the rest
+    of its databases are not tried. Checks still running timeout seconds
+    after they started are reported as slow, and not waited for.
+    After run_timeout seconds the run ends: checks still running are
+    reported as slow and the ones not started yet as skipped.
+    """
+    started = {}
+    down = set()
+    run_deadline = time.time() + run_timeout
+
+    def probe(p):
+        dbinfo, server = p[1], p[2]
+        started[p] = time.time()
+        if started[p] > run_deadline:
+            return SKIPPED, None
+        if server in down:
+            return UNREACHABLE, None
+        status, days = check_db_freshness(dbinfo, db_user, db_pass,
+                                          server[0], server[1], timeout)
+        if status == UNREACHABLE:
+            down.add(server)
+        return status, days
+
+    results = {}
+    if not probes:
+        return results
+
+    pool = ThreadPool(max(1, min(workers, len(probes))))
+    pending = dict([(p, pool.apply_async(probe, (p,))) for p in probes])
+    deadline = timeout + CONNECT_TIMEOUT
+    try:
+        while pending:
+            now = time.time()
+            expired = now > run_deadline
+            for p, res in pending.items():
+                if res.ready():
+                    results[p] = res.get()
+                elif p in started and (expired or now - started[p] > deadline):
+                    logging.error("%s: no answer after %d seconds"
+                                  % (p[1][1], now - started[p]))
+                    results[p] = (SLOW, None)
+                elif expired:
+                    logging.error("%s: not checked in %s seconds" % (p[1][1], run_timeout))
+                    results[p] = (SKIPPED, None)
+                else:
+                    continue
+                del pending[p]
+            if pending:
+                time.sleep(0.2)
+    finally:
+        # Workers stuck in a query are abandoned, not joined
+        pool.terminate()
+
+    return results
+
+def get_tables_info(db, dbnames):
+    """Returns the last update time of the tables in dbnames, and their
+    indexed columns, reading information_schema once.
+
+    The update times are {(database, table): datetime}, None when the
+    server does not keep it (InnoDB before MySQL 5.7). The indexed columns
+    are a set of (database, table, column), first column of an index.
+    """
+    c = db.cursor()
+    marks = ','.join(['%s'] * len(dbnames))
+
+    c.execute("SELECT table_schema, table_name, update_time "
+              "FROM information_schema.TABLES "
+              "WHERE table_schema IN (" + marks + ")", dbnames)
+    update_times = dict([((r[0], r[1]), r[2]) for r in c.fetchall()])
+
+    c.execute("SELECT table_schema, table_name, column_name "
+              "FROM information_schema.STATISTICS "
+              "WHERE seq_in_index = 1 AND table_schema IN (" + marks + ")",
+              dbnames)
+    indexed = set([(r[0], r[1], r[2]) for r in c.fetchall()])
+    c.close()
+
+    return update_times, indexed
+
+def estimate_freshness(probes, db_user, db_pass, thresholds,
+                       default_threshold, margin=MARGIN):
+    """Estimates the age of probes from the update time of their tables.
+
+    A table is updated when data is retrieved, so its update time is a
+    cheap approximation of MAX(date). Only the databases estimated to be
+    fresh by more than margin days are returned, as {probe: (OK, days)};
+    the rest (near or past their threshold, or without update time) need
+    the exact query. Monitored columns without an index are logged.
+    """
+    servers = {}
+    for p in probes:
+        servers.setdefault(p[2], []).append(p)
+
+    now = datetime.datetime.now()
+    estimated = {}
+
+    for server, server_probes in servers.items():
+        host, port = server
+        dbnames = list(set([p[1][1] for p in server_probes]))
+        pool = get_pool('information_schema', db_user, db_pass, host, port,
+                        connect_timeout=CONNECT_TIMEOUT)
+        try:
+            db = pool.get()
+            update_times, indexed = get_tables_info(db, dbnames)
+        except MySQLdb.Error, e:
+            # The exact check will report it
+            logging.error("Can not read information_schema of %s:%s: %s" % (host, port, e))
+            continue
+        pool.put(db)
+
+        for p in server_probes:
+            kind, dbname = p[1]
+            times = []
+            for table, column in MONITORED[kind]:
+                if (dbname, table) not in update_times:
+                    continue
+                times.append(update_times[(dbname, table)])
+                if (dbname, table, column) not in indexed:
+                    logging.info("%s: no index on %s.%s, MAX(%s) reads the whole table"
+                                 % (dbname, table, column, column))
+
+            if not times or None in times:
+                continue
+            days = (now - max(times)).days
+            threshold = thresholds.get(dbname, default_threshold)
+            if days < threshold - margin:
+                estimated[p] = (OK, days)
+
+    logging.debug("%s of %s databases estimated from information_schema"
+                  % (len(estimated), len(probes)))
+    return estimated
+
+class FreshnessHistory(object):
+    """Checks of previous runs, stored in a SQLite file.
+
+    There is a row per (dashboard, database, time of the check), with the
+    status and the age in days found then.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS freshness ("
+                          "dashboard TEXT NOT NULL, "
+                          "db TEXT NOT NULL, "
+                          "checked_at INTEGER NOT NULL, "
+                          "kind TEXT, "
+                          "status TEXT, "
+                          "days INTEGER, "
+                          "estimated INTEGER, "
+                          "PRIMARY KEY (dashboard, db, checked_at))")
+        self.conn.commit()
+
+    def append(self, rows):
+        """Stores rows of (dashboard, db, checked_at, kind, status, days,
+        estimated), all in one transaction"""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO freshness "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def latest(self, since):
+        """Returns {(dashboard, db): (checked_at, days, estimated)} for the
+        databases whose last check done after since was successful. If the
+        last check failed, older successful ones are not returned, so the
+        database is checked again"""
+        cursor = self.conn.execute("SELECT f.dashboard, f.db, f.checked_at, "
+                                   "f.days, f.estimated "
+                                   "FROM freshness f JOIN "
+                                   "(SELECT dashboard, db, MAX(checked_at) AS last "
+                                   " FROM freshness "
+                                   " WHERE checked_at >= ? "
+                                   " GROUP BY dashboard, db) l "
+                                   "ON f.dashboard = l.dashboard AND f.db = l.db "
+                                   "AND f.checked_at = l.last "
+                                   "WHERE f.status = ?", (since, OK))
+        return dict([((r[0], r[1]), (r[2], r[3], bool(r[4]))) for r in cursor])
+
+    def since(self, since):
+        """Generator for the checks done after since, sorted by dashboard,
+        database and time"""
+        cursor = self.conn.execute("SELECT dashboard, db, checked_at, status, days "
+                                   "FROM freshness WHERE checked_at >= ? "
+                                   "ORDER BY dashboard, db, checked_at", (since,))
+        for row in cursor:
+            yield row
+
+    def close(self):
+        self.conn.close()
+
+def lag_trend(samples):
+    """Returns the growth of the age of a database, in days per day.
+
+    samples: list of (time, days). Computed by least squares: near 0
+    while data keeps being retrieved, near 1 when retrieval stopped.
+    """
+    if len(samples) < 2:
+        return None
+    xs = [t / 86400.0 for t, _ in samples]
+    ys = [float(d) for _, d in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum([(x - mean_x) ** 2 for x in xs])
+    if var_x == 0:
+        return None
+    cov = sum([(x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)])
+    return cov / var_x
+
+def trend_report(history, days=TREND_DAYS):
+    """Returns the lines of a report with the lag trend of each database
+    checked in the last days"""
+    lines = []
+    since = int(time.time()) - days * 86400
+
+    group = None
+    samples = []
+    failures = 0
+
+    def report_line():
+        dashboard, db = group
+        if not samples:
+            return '%s %s: %d checks failed' % (dashboard, db, failures)
+        ages = [d for _, d in samples]
+        trend = lag_trend(samples)
+        trend = 'n/a' if trend is None else '%+.2f days/day' % trend
+        return ('%s %s: lag %d days (min %d, max %d), growth %s, '
+                '%d checks, %d failed' % (dashboard, db, ages[-1], min(ages),
+                                          max(ages), trend,
+                                          len(samples) + failures, failures))
+
+    for dashboard, db, checked_at, status, age in history.since(since):
+        if (dashboard, db) != group:
+            if group:
+                lines.append(report_line())
+            group = (dashboard, db)
+            samples = []
+            failures = 0
+        if status == OK:
+            samples.append((checked_at, age))
+        else:
+            failures += 1
+    if group:
+        lines.append(report_line())
+
+    return lines
 
 def find(pattern, root):
     result = []
@@ -129,7 +502,19 @@ def read_opts_file(file_name):
     opts['log_file'] = Config.get('config','log_file')
     opts['db_user'] = Config.get('config','db_user')
     opts['db_pass'] = Config.get('config','db_pass')
+    try:
+        opts['db_host'] = Config.get('config','db_host')
+    except:
+        opts['db_host'] = 'localhost'
+    try:
+        opts['db_port'] = int(Config.get('config','db_port'))
+    except:
+        opts['db_port'] = 3306
     opts['default_threshold'] = int(Config.get('config','default_threshold'))
+    try:
+        opts['history_file'] = Config.get('config','history_file')
+    except:
+        opts['history_file'] = ''
     try:
         opts['email_from'] = Config.get('config','email_from')
     except:
@@ -149,6 +534,19 @@ def produce_report(data, general_threshold, adhoc_thresholds, msg_from, msg_to='
         for db in data[p].keys():
             age = data[p][db]['days']
             dbname = data[p][db]['dbname']
+            status = data[p][db].get('status', OK)
+
+            if status != OK:
+                logging.info('     %s: %s' % (dbname, status))
+                aux_lines.append(' %s: %s' % (dbname, status))
+                continue
+
+            if data[p][db].get('estimated'):
+                # Never reported, only fresh databases are estimated
+                logging.info('     %s: %s days (estimated)' % (dbname, str(age)))
+                continue
+            if data[p][db].get('cached'):
+                logging.info('     %s: %s days (from history)' % (dbname, str(age)))
 
             if adhoc_thresholds.has_key(dbname):
                 max_age = adhoc_thresholds[dbname]
@@ -189,20 +587,78 @@ def main():
     logging.info("---")
     logging.info("The owl is watching its SQL territory ..")
     logging.debug("default_threshold = %s" % (str(conf['default_threshold'])))
+
+    history = None
+    if conf['history_file']:
+        history = FreshnessHistory(conf['history_file'])
+    elif args.trend is not None or args.ttl:
+        raise Exception("history_file is not set in %s" % args.config_file)
+
+    if args.trend is not None:
+        for line in trend_report(history, args.trend):
+            print line
+        history.close()
+        return
+
     conf_files = find('conf/main.conf', conf['dashboards_root'])
 
     result = {}
+    probes = []
 
     for c in conf_files:
         result[c] = {}
 
+        server = get_db_server(c, conf['db_host'], conf['db_port'])
         mydbs = get_databases(c)
         for m in mydbs.items():
-            aux = {}
-            aux["dbname"] = m[1]
-            aux["days"] = check_db_freshness(m, conf['db_user'], conf['db_pass'])
-            result[c][m[0]] = aux
-        logging.debug("SQL data gathered for %s" % c)
+            probes.append((c, m, server))
+
+    now = int(time.time())
+
+    # Databases checked less than ttl minutes ago are not checked again.
+    # Their age is the one found then, plus the time passed. Estimated
+    # ages stay estimated, so they never raise an alarm
+    cached = {}
+    if history and args.ttl > 0:
+        latest = history.latest(now - args.ttl * 60)
+        for p in probes:
+            key = (p[0], p[1][1])
+            if key in latest:
+                checked_at, days, was_estimated = latest[key]
+                cached[p] = (OK, days + (now - checked_at) // 86400, was_estimated)
+        logging.debug("%s databases checked less than %s minutes ago"
+                      % (len(cached), args.ttl))
+    probes_left = [p for p in probes if p not in cached]
+
+    estimated = {}
+    if args.fast:
+        estimated = estimate_freshness(probes_left, conf['db_user'], conf['db_pass'],
+                                       thresholds, conf['default_threshold'],
+                                       args.margin)
+
+    checked = probe_databases([p for p in probes_left if p not in estimated],
+                              conf['db_user'], conf['db_pass'],
+                              args.workers, args.timeout, args.run_timeout)
+    checked.update(estimated)
+
+    for p in probes:
+        c, m = p[0], p[1]
+        aux = {}
+        aux["dbname"] = m[1]
+        if p in cached:
+            aux["status"], aux["days"], aux["estimated"] = cached[p]
+        else:
+            aux["status"], aux["days"] = checked[p]
+            aux["estimated"] = p in estimated
+        aux["cached"] = p in cached
+        result[c][m[0]] = aux
+    logging.debug("SQL data gathered for %s dashboards" % len(conf_files))
+
+    if history:
+        history.append([(p[0], p[1][1], now, p[1][0], checked[p][0],
+                         checked[p][1], int(p in estimated))
+                         for p in probes_left])
+        history.close()
 
     produce_report(result, conf['default_threshold'], thresholds,
                     conf['email_from'], conf['email_to'])